@@ -0,0 +1,148 @@
+import contextlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterator, Optional, Set
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+audio_cache_options = {
+    'directory': 'audio_cache',
+    'max_bytes': 2 * 1024 ** 3,
+    # Songs are downloaded once they have been played this often
+    'play_threshold': 3,
+    # A download claim older than this belongs to a process that died mid download
+    'claim_timeout': 900,
+}
+
+cache_file_re = re.compile(r"^(\d+)\.mp3$")
+
+
+class AudioCache:
+    # The directory can be shared by several shard processes. Each one only keeps a view of it: a lock file
+    # serializes rescans and eviction so max_bytes holds for the directory, claim files stop two processes
+    # from downloading the same song.
+    # Everything touching the disk may block on another process' lock, the Getter calls it from an executor.
+    def __init__(self, directory: str = 'audio_cache', max_bytes: int = 2 * 1024 ** 3, play_threshold: int = 3,
+                 claim_timeout: float = 900):
+        self.directory: str = directory
+        self.max_bytes: int = max_bytes
+        self.play_threshold: int = play_threshold
+        self.claim_timeout: float = claim_timeout
+        # song id -> file size, least recently used first
+        self.entries: OrderedDict[int, int] = OrderedDict()
+        self.size: int = 0
+        self.downloading: Set[int] = set()
+        # Guards entries and size, executor threads and the event loop both use them
+        self.lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        with self.locked():
+            self.scan()
+
+    @contextlib.contextmanager
+    def locked(self) -> Iterator[None]:
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def scan(self):
+        # Rebuilt from the directory, other processes add and evict files too
+        files = []
+        for name in os.listdir(self.directory):
+            match = cache_file_re.match(name)
+            if match:
+                with contextlib.suppress(FileNotFoundError):
+                    stat = os.stat(os.path.join(self.directory, name))
+                    files.append((stat.st_mtime, int(match.group(1)), stat.st_size))
+        entries = OrderedDict((song_id, size) for _, song_id, size in sorted(files))
+        with self.lock:
+            self.entries = entries
+            self.size = sum(entries.values())
+            self.evict()
+
+    def path_for(self, song_id: int) -> str:
+        return os.path.join(self.directory, f"{song_id}.mp3")
+
+    def template_for(self, song_id: int) -> str:
+        # yt-dlp output template, FFmpegExtractAudio swaps the extension to mp3
+        return os.path.join(self.directory, f"{song_id}.%(ext)s")
+
+    def claim_path(self, song_id: int) -> str:
+        return os.path.join(self.directory, f"{song_id}.claim")
+
+    def get(self, song_id: int) -> Optional[str]:
+        path = self.path_for(song_id)
+        try:
+            # mtime keeps the LRU order across restarts and between processes
+            os.utime(path)
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            with self.lock:
+                if song_id in self.entries:
+                    self.size -= self.entries.pop(song_id)
+            return None
+        with self.lock:
+            if song_id not in self.entries:
+                # Downloaded by another process
+                self.entries[song_id] = size
+                self.size += size
+            self.entries.move_to_end(song_id)
+        return path
+
+    def wants(self, song_id: int, play_count: int) -> bool:
+        return play_count >= self.play_threshold and song_id not in self.entries and song_id not in self.downloading
+
+    def claim(self, song_id: int) -> bool:
+        path = self.claim_path(song_id)
+        with self.locked():
+            if os.path.exists(self.path_for(song_id)):
+                return False
+            try:
+                if time.time() - os.path.getmtime(path) < self.claim_timeout:
+                    return False
+            except FileNotFoundError:
+                pass
+            with open(path, "w"):
+                pass
+        self.downloading.add(song_id)
+        return True
+
+    def release(self, song_id: int):
+        self.downloading.discard(song_id)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.claim_path(song_id))
+
+    def add(self, song_id: int) -> bool:
+        with self.locked():
+            if not os.path.exists(self.path_for(song_id)):
+                return False
+            # Just written, so the newest file and the last to be evicted
+            self.scan()
+            return song_id in self.entries
+
+    def remove(self, song_id: int):
+        with self.lock:
+            size = self.entries.pop(song_id, None)
+            if size is not None:
+                self.size -= size
+        try:
+            os.remove(self.path_for(song_id))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        while self.size > self.max_bytes and self.entries:
+            song_id = next(iter(self.entries))
+            self.remove(song_id)
@@ -1,10 +1,19 @@
+import asyncio
+import re
+import datetime
+import time
 from enum import Enum
-from typing import Type, TypeVar, List
-from sqlalchemy import create_engine, MetaData, Column, String, Double, Integer, ForeignKey, TIMESTAMP, Table
+from typing import Dict, Iterator, NamedTuple, Set, Type, TypeVar, List, Optional, Tuple
+from sqlalchemy import MetaData, Column, String, Double, Integer, ForeignKey, TIMESTAMP, Table, Boolean, text, select, event, func, insert, update, delete, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.automap import automap_base
-from sqlalchemy.orm import Session, declarative_base, relationship
+from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy.sql.functions import current_timestamp
 
+import Metrics
+
 Base = declarative_base()
 
 songs_playlists = Table(
@@ -30,10 +39,33 @@ class Song(Base):
     duration = Column(Double)
     platform = Column(Integer, ForeignKey('Platforms.id'))
 
-    platforms = relationship("Platform", back_populates="songs")
-    artists = relationship("Artist", back_populates="songs")
+    # Sessions are short lived, everything read off a Song later on has to be loaded up front
+    platforms = relationship("Platform", back_populates="songs", lazy="joined")
+    artists = relationship("Artist", back_populates="songs", lazy="joined")
     playlist = relationship("Playlist", secondary=songs_playlists, back_populates="songs")
-    songstats = relationship("Songstats", back_populates="songs", uselist=False)
+    songstats = relationship("Songstats", back_populates="songs", uselist=False, lazy="selectin")
+
+
+class SongRecord(NamedTuple):
+    # Plain immutable copy of a Songs row for queues and embeds, nothing on it can trigger SQL.
+    # The artist is its name, which is what Songs.artist stores, and platform is the Platforms id.
+    id: int
+    name: str
+    url: Optional[str]
+    duration: float
+    artist: Optional[str]
+    platform: Optional[int]
+
+    @classmethod
+    def from_song(cls, song: "Song") -> "SongRecord":
+        return cls(song.id, song.name, song.url, song.duration or 0, song.artist, song.platform)
+
+# Everything a SongRecord needs, selected as columns so no ORM identity map or relationship loading is involved
+song_record_columns = (Song.id, Song.name, Song.url, Song.duration, Song.artist, Song.platform)
+
+
+def to_record(row) -> SongRecord:
+    return SongRecord(row[0], row[1], row[2], row[3] or 0, row[4], row[5])
 
 
 class Platform(Base):
@@ -59,101 +91,713 @@ class Playlist(Base):
     name = Column(String)
     songs = relationship("Song", secondary=songs_playlists, back_populates="playlist")
 
+class SearchCache(Base):
+    __tablename__ = 'SearchCache'
+    query = Column(String, primary_key=True)
+    # NULL marks a search that found nothing
+    song_id = Column(Integer, ForeignKey('Songs.id'), nullable=True)
+    created = Column(TIMESTAMP, default=current_timestamp)
+
+class IdBlock(Base):
+    __tablename__ = 'IdBlocks'
+    # Next id nobody has reserved yet, shared by every process working on the same database file
+    name = Column(String, primary_key=True)
+    next_id = Column(Integer)
+
+class SavedPlayer(Base):
+    __tablename__ = 'SavedPlayers'
+    guild_id = Column(Integer, primary_key=True)
+    channel_id = Column(Integer)
+    song_id = Column(Integer, ForeignKey('Songs.id'), nullable=True)
+    # Position in the current song, rewritten every journal interval while it plays. Time the bot was down
+    # doesn't count, the song picks up where it was last heard.
+    elapsed = Column(Double, nullable=True)
+    fair = Column(Boolean, default=False)
+
+class SavedQueueEntry(Base):
+    __tablename__ = 'SavedQueueEntries'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    guild_id = Column(Integer, index=True)
+    position = Column(Integer)
+    song_id = Column(Integer, ForeignKey('Songs.id'))
+    user_id = Column(Integer, nullable=True)
+
 T = TypeVar("T", bound=Base)
 
-class Database:
+# Trigram FTS5 index over song and artist names, kept in sync with Songs by triggers
+search_index_ddl = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS SongSearch USING fts5(
+        name, artist, content='Songs', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS SongSearch_insert AFTER INSERT ON Songs BEGIN
+        INSERT INTO SongSearch(rowid, name, artist) VALUES (new.id, new.name, new.artist);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS SongSearch_delete AFTER DELETE ON Songs BEGIN
+        INSERT INTO SongSearch(SongSearch, rowid, name, artist) VALUES ('delete', old.id, old.name, old.artist);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS SongSearch_update AFTER UPDATE OF name, artist ON Songs BEGIN
+        INSERT INTO SongSearch(SongSearch, rowid, name, artist) VALUES ('delete', old.id, old.name, old.artist);
+        INSERT INTO SongSearch(rowid, name, artist) VALUES (new.id, new.name, new.artist);
+    END""",
+]
+
+index_ddl = [
+    "CREATE INDEX IF NOT EXISTS Songstats_song ON Songstats (song_id)",
+    "CREATE INDEX IF NOT EXISTS Songs_url ON Songs (url)",
+]
+
+# Columns added to tables that earlier versions already created, create_all leaves existing tables alone
+added_columns = {
+    'SavedPlayers': {'elapsed': 'DOUBLE'},
+}
+
+# Name matches weigh more than artist matches, play count pushes popular songs up
+search_query = text("""
+    SELECT Songs.id, Songs.name, Songs.url, Songs.duration, Songs.artist, Songs.platform
+    FROM SongSearch JOIN Songs ON Songs.id = SongSearch.rowid
+    WHERE SongSearch MATCH :query
+    ORDER BY bm25(SongSearch, 10.0, 1.0)
+        * (1 + 0.1 * COALESCE((SELECT MAX(play_count) FROM Songstats WHERE song_id = SongSearch.rowid), 0))
+    LIMIT :limit
+""")
+
+search_term_re = re.compile(r"\w+")
+
+
+def to_fts_query(name: str) -> Optional[str]:
+    # Trigram tokens need at least three characters. A query with a shorter word can't be expressed
+    # without dropping that word, so it goes to the LIKE search instead.
+    terms = search_term_re.findall(name.lower())
+    if not terms or any(len(t) < 3 for t in terms):
+        return None
+    return " ".join(f'"{t}"' for t in terms)
+
+
+def compact_name(name: str) -> str:
+    return name.replace(' ', '').lower()
+
+
+database_options = {
+    'url': "sqlite+aiosqlite:///musiDB.sb",
+    'echo': False,
+    # Deferred writes are flushed in one transaction every interval or once this many are pending
+    'flush_interval': 5.0,
+    'flush_threshold': 100,
+    # After this many failed flushes in a row rows are written one by one, the ones that still fail are dropped
+    'flush_retries': 3,
+    # Ids of deferred rows are reserved this many at a time
+    'id_block_size': 50,
+}
+
+sqlite_pragmas = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,
+    'temp_store': 'MEMORY',
+    'mmap_size': 256 * 1024 ** 2,
+    'busy_timeout': 5000,
+}
+
+
+def set_sqlite_pragmas(dbapi_connection, _connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in sqlite_pragmas.items():
+        cursor.execute(f"PRAGMA {pragma} = {value}")
+    cursor.close()
+
+
+def start_query_timer(_conn, _cursor, _statement, _parameters, context, _executemany):
+    context._query_started = time.perf_counter()
+
+
+def stop_query_timer(_conn, _cursor, _statement, _parameters, context, _executemany):
+    Metrics.db_query_seconds.observe(time.perf_counter() - context._query_started)
+
+
+def row_values(obj: Base) -> dict:
+    return {c.key: getattr(obj, c.key) for c in obj.__table__.columns}
+
+
+class WriteBuffer:
     def __init__(self):
-        self.engine = create_engine("sqlite:///musiDB.sb", echo=True)
+        self.inserts: Dict[type, Dict[object, Base]] = {}
+        self.updates: Dict[type, Dict[object, Base]] = {}
+        # song id -> (plays since last flush, last played)
+        self.plays: Dict[int, Tuple[int, datetime.datetime]] = {}
+        # song id -> stream url, written on its own so the rest of the row is left alone
+        self.stream_urls: Dict[int, str] = {}
+        self.by_url: Dict[Tuple[type, str], Base] = {}
+        self.by_name: Dict[Tuple[type, str], Base] = {}
+        # Rows of a running flush, lookups still find them here until their transaction is committed
+        self.flushing: Optional[WriteBuffer] = None
+
+    def __len__(self) -> int:
+        return sum(len(r) for r in self.inserts.values()) + sum(len(r) for r in self.updates.values()) \
+            + len(self.plays) + len(self.stream_urls)
+
+    def add(self, obj: Base):
+        table = type(obj)
+        self.inserts.setdefault(table, {})[obj.__mapper__.primary_key_from_instance(obj)[0]] = obj
+        if getattr(obj, 'url', None):
+            self.by_url[(table, obj.url)] = obj
+        if getattr(obj, 'name', None):
+            self.by_name[(table, obj.name)] = obj
+
+    def update(self, obj: Base):
+        table = type(obj)
+        key = obj.__mapper__.primary_key_from_instance(obj)[0]
+        # A pending insert already carries the latest values of the object
+        if key not in self.inserts.get(table, {}):
+            self.updates.setdefault(table, {})[key] = obj
+
+    def add_play(self, song_id: int, when: datetime.datetime):
+        count, _ = self.plays.get(song_id, (0, when))
+        self.plays[song_id] = (count + 1, when)
+
+    def set_stream_url(self, song_id: int, url: str):
+        pending = self.inserts.get(Song, {}).get(song_id)
+        if pending is not None:
+            pending.stream_url = url
+        else:
+            self.stream_urls[song_id] = url
+
+    def find_by_url(self, table: type, url: str) -> Optional[Base]:
+        found = self.by_url.get((table, url))
+        return found if found is not None or self.flushing is None else self.flushing.find_by_url(table, url)
+
+    def find_by_name(self, table: type, name: str) -> Optional[Base]:
+        found = self.by_name.get((table, name))
+        return found if found is not None or self.flushing is None else self.flushing.find_by_name(table, name)
+
+    def find(self, table: type, key) -> Optional[Base]:
+        found = self.inserts.get(table, {}).get(key)
+        return found if found is not None or self.flushing is None else self.flushing.find(table, key)
+
+    def pending(self, table: type) -> List[Base]:
+        rows = list(self.inserts.get(table, {}).values())
+        return rows + self.flushing.pending(table) if self.flushing else rows
+
+    def take(self) -> "WriteBuffer":
+        taken = WriteBuffer()
+        taken.inserts, taken.updates, taken.plays, taken.stream_urls = self.inserts, self.updates, self.plays, self.stream_urls
+        taken.by_url, taken.by_name = self.by_url, self.by_name
+        self.inserts, self.updates, self.plays, self.stream_urls = {}, {}, {}, {}
+        self.by_url, self.by_name = {}, {}
+        self.flushing = taken
+        return taken
+
+    def committed(self):
+        self.flushing = None
+
+    def split(self) -> Iterator[Tuple[str, Set[int], "WriteBuffer"]]:
+        # One buffer per row in flush order, with a label for the log and the song ids the row depends on
+        for table in insert_order:
+            for key, obj in self.inserts.get(table, {}).items():
+                single = WriteBuffer()
+                single.inserts[table] = {key: obj}
+                song_id = getattr(obj, 'song_id', None)
+                yield f"insert {table.__name__} {key}", set() if table is Song or song_id is None else {song_id}, single
+        for table, rows in self.updates.items():
+            for key, obj in rows.items():
+                single = WriteBuffer()
+                single.updates[table] = {key: obj}
+                yield f"update {table.__name__} {key}", set(), single
+        for song_id, url in self.stream_urls.items():
+            single = WriteBuffer()
+            single.stream_urls[song_id] = url
+            yield f"stream url of song {song_id}", {song_id}, single
+        for song_id, play in self.plays.items():
+            single = WriteBuffer()
+            single.plays[song_id] = play
+            yield f"plays of song {song_id}", {song_id}, single
+
+    def restore(self, taken: "WriteBuffer"):
+        self.flushing = None
+        for rows in taken.inserts.values():
+            for obj in rows.values():
+                self.add(obj)
+        for rows in taken.updates.values():
+            for obj in rows.values():
+                self.update(obj)
+        for song_id, (count, when) in taken.plays.items():
+            pending, _ = self.plays.get(song_id, (0, when))
+            self.plays[song_id] = (pending + count, when)
+        for song_id, url in taken.stream_urls.items():
+            # A newer url resolved since the failed flush wins
+            self.stream_urls.setdefault(song_id, url)
+
+
+# Parents first so foreign keys point at rows that already exist
+insert_order = [Platform, Artist, Playlist, Song, Songstats, SearchCache]
+# Rows of these tables replace existing ones with the same key instead of being skipped
+upsert_tables = {SearchCache}
+
+
+class Database:
+    def __init__(self, url: str = "sqlite+aiosqlite:///musiDB.sb", echo: bool = False,
+                 flush_interval: float = 5.0, flush_threshold: int = 100, flush_retries: int = 3, id_block_size: int = 50):
+        self.engine = create_async_engine(url, echo=echo)
+        event.listen(self.engine.sync_engine, "connect", set_sqlite_pragmas)
+        event.listen(self.engine.sync_engine, "before_cursor_execute", start_query_timer)
+        event.listen(self.engine.sync_engine, "after_cursor_execute", stop_query_timer)
         self.base = Base
-        self.session = Session(self.engine)
+        # expire_on_commit=False keeps returned rows usable after their session is gone
+        self.sessionmaker = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.fts: bool = False
+        self.flush_interval: float = flush_interval
+        self.flush_threshold: int = flush_threshold
+        self.flush_retries: int = flush_retries
+        self.flush_failures: int = 0
+        self.writes: WriteBuffer = WriteBuffer()
+        self.flush_lock = asyncio.Lock()
+        self.flusher: Optional[asyncio.Task] = None
+        self.id_block_size: int = id_block_size
+        # table -> (next id to hand out, end of the reserved block)
+        self.id_blocks: Dict[type, Tuple[int, int]] = {}
+        self.id_lock = asyncio.Lock()
+        self.play_counts: Dict[int, int] = {}
+
+    async def setup(self):
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all, tables=[SearchCache.__table__, IdBlock.__table__, SavedPlayer.__table__, SavedQueueEntry.__table__])
+            for ddl in index_ddl:
+                await conn.execute(text(ddl))
+            for table, columns in added_columns.items():
+                existing = {row[1] for row in (await conn.execute(text(f"PRAGMA table_info({table})"))).all()}
+                for column, kind in columns.items():
+                    if column not in existing:
+                        await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {kind}"))
+        self.fts = await self.create_search_index()
+        self.flusher = asyncio.create_task(self.flush_periodically())
+
+    async def close(self):
+        if self.flusher:
+            self.flusher.cancel()
+            self.flusher = None
+        await self.flush()
+        await self.engine.dispose()
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def flush_soon(self):
+        if len(self.writes) >= self.flush_threshold:
+            asyncio.ensure_future(self.flush())
+
+    async def flush(self) -> int:
+        async with self.flush_lock:
+            taken = self.writes.take()
+            count = len(taken)
+            if count == 0:
+                self.writes.committed()
+                return 0
+            try:
+                if self.flush_failures >= self.flush_retries:
+                    count = await self.salvage(taken)
+                else:
+                    async with self.session() as session:
+                        await self.write(session, taken)
+                        await session.commit()
+            except Exception as e:
+                self.flush_failures += 1
+                print(f"Could not flush {count} pending writes: {e}")
+                self.writes.restore(taken)
+                return 0
+            self.flush_failures = 0
+            self.writes.committed()
+            return count
+
+    async def write(self, session: AsyncSession, taken: WriteBuffer):
+        for table in insert_order:
+            rows = taken.inserts.get(table)
+            if rows:
+                if table in upsert_tables:
+                    statement = insert(table).prefix_with("OR REPLACE")
+                else:
+                    # Only a row that already exists under the same key is skipped, NOT NULL and
+                    # foreign key violations still fail the flush instead of vanishing silently
+                    statement = sqlite_insert(table).on_conflict_do_nothing(
+                        index_elements=[c.name for c in table.__table__.primary_key])
+                await session.execute(statement, [row_values(o) for o in rows.values()])
+        for table, rows in taken.updates.items():
+            for obj in rows.values():
+                pk = obj.__mapper__.primary_key[0]
+                await session.execute(update(table).where(pk == getattr(obj, pk.key)).values(row_values(obj)))
+        if taken.stream_urls:
+            # On the Table, the ORM would treat a parameter list as a bulk update by primary key
+            songs = Song.__table__
+            await session.execute(
+                update(songs).where(songs.c.id == bindparam("song_id")).values(stream_url=bindparam("stream")),
+                [{"song_id": i, "stream": u} for i, u in taken.stream_urls.items()]
+            )
+        for song_id, (plays, when) in taken.plays.items():
+            result = await session.execute(
+                update(Songstats).where(Songstats.song_id == song_id)
+                .values(play_count=func.coalesce(Songstats.play_count, 0) + plays, last_played=when)
+            )
+            if result.rowcount == 0:
+                await session.execute(insert(Songstats).values(song_id=song_id, play_count=plays, last_played=when))
 
-    def get_all(self, table: Type[T]) -> List[T]:
-        return self.session.query(table).all()
+    async def salvage(self, taken: WriteBuffer) -> int:
+        # Every row in a savepoint of its own, so one that keeps failing can't hold back every later write
+        written = 0
+        dropped: Set[int] = set()
+        async with self.session() as session:
+            for label, songs, single in taken.split():
+                if songs & dropped:
+                    print(f"Dropping pending write, its song was dropped: {label}")
+                    continue
+                try:
+                    async with session.begin_nested():
+                        await self.write(session, single)
+                    written += len(single)
+                except Exception as e:
+                    print(f"Dropping pending write that keeps failing: {label}: {e}")
+                    dropped.update(single.inserts.get(Song, {}).keys())
+            await session.commit()
+        return written
 
-    def get_by_id(self, table: Type[T], id: int) -> T:
+    async def reserve_ids(self, table: Type[T]) -> Tuple[int, int]:
+        async with self.session() as session:
+            try:
+                seq = (await session.execute(
+                    text("SELECT seq FROM sqlite_sequence WHERE name = :name"), {"name": table.__tablename__}
+                )).scalar() or 0
+            except OperationalError:
+                # Only exists once a table declared with AUTOINCREMENT got its first row
+                seq = 0
+            # One statement, so concurrent shards serialize on SQLite's write lock instead of racing.
+            # The max(id) floor also steps over rows that were inserted without a reserved id.
+            end = (await session.execute(text(
+                f"INSERT INTO IdBlocks (name, next_id) "
+                f"VALUES (:name, max(:seq, (SELECT coalesce(max(id), 0) FROM {table.__tablename__})) + 1 + :size) "
+                f"ON CONFLICT(name) DO UPDATE SET next_id = "
+                f"max(next_id, (SELECT coalesce(max(id), 0) + 1 FROM {table.__tablename__})) + :size "
+                f"RETURNING next_id"
+            ), {"name": table.__tablename__, "seq": seq, "size": self.id_block_size})).scalar()
+            await session.commit()
+        return end - self.id_block_size, end
+
+    async def allocate_id(self, table: Type[T]) -> int:
+        # Deferred rows need their id before they reach the database. Ids come in blocks reserved in IdBlocks,
+        # so several bot processes on the same file never hand out the same one. Unused ids of a block are skipped.
+        start, end = self.id_blocks.get(table, (0, 0))
+        if start >= end:
+            async with self.id_lock:
+                start, end = self.id_blocks.get(table, (0, 0))
+                if start >= end:
+                    start, end = await self.reserve_ids(table)
+                self.id_blocks[table] = (start + 1, end)
+                return start
+        self.id_blocks[table] = (start + 1, end)
+        return start
+
+    def session(self) -> AsyncSession:
+        return self.sessionmaker()
+
+    async def create_search_index(self) -> bool:
+        try:
+            async with self.engine.begin() as conn:
+                exists = (await conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'SongSearch'"))).first()
+                for ddl in search_index_ddl:
+                    await conn.execute(text(ddl))
+                if not exists:
+                    await conn.execute(text("INSERT INTO SongSearch(SongSearch) VALUES ('rebuild')"))
+            return True
+        except OperationalError as e:
+            print(f"FTS5 search index unavailable, falling back to LIKE search: {e}")
+            return False
+
+    async def get_all(self, table: Type[T]) -> List[T]:
+        async with self.session() as session:
+            return list((await session.scalars(select(table))).unique().all())
+
+    async def get_by_id(self, table: Type[T], id: int) -> T:
         if not hasattr(table, 'id'):
             raise ValueError(f"Table {table.__tablename__} does not have an 'id' column.")
-        return self.session.query(table).filter(table.id == id).first()
+        pending = self.writes.find(table, id)
+        if pending is not None:
+            return pending
+        async with self.session() as session:
+            return (await session.scalars(select(table).filter(table.id == id))).first()
 
-    def get_bulk_by_id(self, table: Type[T], id: List[int]) -> List[T]:
+    async def get_bulk_by_id(self, table: Type[T], id: List[int]) -> List[T]:
         if not hasattr(table, 'id'):
             raise ValueError(f"Table {table.__tablename__} does not have an 'id' column.")
-        return self.session.query(table).filter(table.id.in_(id)).all()
+        async with self.session() as session:
+            return list((await session.scalars(select(table).filter(table.id.in_(id)))).unique().all())
 
-    def get_by_name(self, table: Type[T], name: str) -> T:
+    async def get_by_name(self, table: Type[T], name: str) -> T:
         if not hasattr(table, 'name'):
             raise ValueError(f"Table {table.__tablename__} does not have a 'name' column.")
 
         search_term = f"%{name.replace(' ', '').lower()}%"
 
-        from sqlalchemy import func
-        return (
-            self.session.query(table)
-            .filter(func.replace(func.lower(table.name), ' ', '').like(search_term))
-            .first()
-        )
+        async with self.session() as session:
+            return (await session.scalars(
+                select(table).filter(func.replace(func.lower(table.name), ' ', '').like(search_term)).limit(1)
+            )).first()
+
+    async def search_songs(self, name: str, limit: int = 10) -> List[SongRecord]:
+        query = to_fts_query(name)
+        if not self.fts or query is None:
+            song = await self.get_by_name(Song, name)
+            return [SongRecord.from_song(song)] if song else []
+        async with self.session() as session:
+            return [to_record(r) for r in (await session.execute(search_query, {"query": query, "limit": limit})).all()]
 
-    def get_bulk_by_name(self, table: Type[T], name: List[str]) -> List[T]:
+    async def search_song(self, name: str) -> Optional[SongRecord]:
+        # FTS only narrows down candidates. A hit still has to contain the whole query in its name, like the
+        # LIKE search demands, otherwise "take on me" would settle for "Take Me To Church" over a remote search.
+        wanted = compact_name(name)
+        for song in await self.search_songs(name):
+            if wanted in compact_name(song.name):
+                return song
+        return None
+
+    async def get_bulk_by_name(self, table: Type[T], name: List[str]) -> List[T]:
         if not hasattr(table, 'name'):
             raise ValueError(f"Table {table.__tablename__} does not have a 'name' column.")
-        return self.session.query(table).filter(table.name.in_(name)).all()
+        async with self.session() as session:
+            return list((await session.scalars(select(table).filter(table.name.in_(name)))).unique().all())
 
-    def get_by_url(self, table: Type[T], url: str) -> T:
+    async def get_by_url(self, table: Type[T], url: str) -> T:
         if not hasattr(table, 'url'):
             raise ValueError(f"Table {table.__tablename__} does not have a 'url' column.")
-        return self.session.query(table).filter(table.url == url).first()
+        pending = self.writes.find_by_url(table, url)
+        if pending is not None:
+            return pending
+        async with self.session() as session:
+            return (await session.scalars(select(table).filter(table.url == url).limit(1))).first()
 
-    def get_bulk_by_url(self, table: Type[T], url: List[str]) -> List[T]:
+    async def get_bulk_by_url(self, table: Type[T], url: List[str]) -> List[T]:
         if not hasattr(table, 'url'):
             raise ValueError(f"Table {table.__tablename__} does not have a 'url' column.")
-        return self.session.query(table).filter(table.url.in_(url)).all()
+        async with self.session() as session:
+            return list((await session.scalars(select(table).filter(table.url.in_(url)))).unique().all())
 
-    def get_or_add_by_name(self, table: Type[T], name: str) -> T:
-        obj = self.get_by_name(table, name)
+    async def get_or_add_by_name(self, table: Type[T], name: str, deferred: bool = False) -> T:
+        obj = self.writes.find_by_name(table, name) or await self.get_by_name(table, name)
         if obj is None:
             obj = table(name=name)
-            self.session.add(obj)
-            self.session.commit()
+            if deferred:
+                await self.defer_add(table, obj)
+                return obj
+            try:
+                await self.add(table, obj)
+            except IntegrityError:
+                # Another lookup added the same name in the meantime
+                obj = await self.get_by_name(table, name)
         return obj
 
-    def add(self, table: Type[T], obj: T) -> bool:
+    async def defer_add(self, table: Type[T], obj: T) -> bool:
+        if not isinstance(obj, table):
+            raise ValueError(f"Object must be an instance of {table.__name__}.")
+        if hasattr(table, 'id') and obj.id is None:
+            obj.id = await self.allocate_id(table)
+        self.writes.add(obj)
+        self.flush_soon()
+        return True
+
+    async def defer_update(self, table: Type[T], obj: T) -> bool:
         if not isinstance(obj, table):
             raise ValueError(f"Object must be an instance of {table.__name__}.")
-        self.session.add(obj)
-        self.session.commit()
+        self.writes.update(obj)
+        self.flush_soon()
         return True
 
-    def add_bulk(self, table: Type[T], obj: List[T]) -> bool:
+    async def record_play(self, song_id: int) -> int:
+        if song_id not in self.play_counts:
+            async with self.session() as session:
+                self.play_counts[song_id] = (await session.execute(
+                    select(func.max(Songstats.play_count)).filter(Songstats.song_id == song_id)
+                )).scalar() or 0
+        self.play_counts[song_id] += 1
+        self.writes.add_play(song_id, datetime.datetime.now())
+        self.flush_soon()
+        return self.play_counts[song_id]
+
+    async def add(self, table: Type[T], obj: T) -> bool:
+        if not isinstance(obj, table):
+            raise ValueError(f"Object must be an instance of {table.__name__}.")
+        async with self.session() as session:
+            session.add(obj)
+            await session.commit()
+        return True
+
+    async def add_bulk(self, table: Type[T], obj: List[T]) -> bool:
         if not all(isinstance(o, table) for o in obj):
             raise ValueError(f"All objects must be instances of {table.__name__}.")
-        self.session.add_all(obj)
-        self.session.commit()
+        async with self.session() as session:
+            session.add_all(obj)
+            await session.commit()
         return True
 
-    def update(self, table: Type[T], obj: T) -> bool:
+    async def update(self, table: Type[T], obj: T) -> bool:
         if not isinstance(obj, table):
             raise ValueError(f"Object must be an instance of {table.__name__}.")
-        self.session.merge(obj)
-        self.session.commit()
+        async with self.session() as session:
+            await session.merge(obj)
+            await session.commit()
         return True
 
-    def delete(self, table: Type[T], obj: T) -> bool:
+    async def delete(self, table: Type[T], obj: T) -> bool:
         if not isinstance(obj, table):
             raise ValueError(f"Object must be an instance of {table.__name__}.")
-        self.session.delete(obj)
-        self.session.commit()
+        async with self.session() as session:
+            await session.delete(await session.merge(obj))
+            await session.commit()
         return True
 
-    def delete_bulk(self, table: Type[T], obj: List[T]) -> bool:
+    async def delete_bulk(self, table: Type[T], obj: List[T]) -> bool:
         if not all(isinstance(o, table) for o in obj):
             raise ValueError(f"All objects must be instances of {table.__name__}.")
-        for o in obj:
-            self.session.delete(o)
-        self.session.commit()
+        async with self.session() as session:
+            for o in obj:
+                await session.delete(await session.merge(o))
+            await session.commit()
         return True
 
-    def get_dummy(self, table: Type[T]) -> T:
+    async def get_search_cache(self, query: str) -> Optional[SearchCache]:
+        pending = self.writes.find(SearchCache, query)
+        if pending is not None:
+            return pending
+        async with self.session() as session:
+            return await session.get(SearchCache, query)
+
+    async def put_search_cache(self, query: str, song_id: Optional[int]) -> bool:
+        return await self.defer_add(SearchCache, SearchCache(query=query, song_id=song_id, created=datetime.datetime.now()))
+
+    async def get_song_record(self, song_id: int) -> Optional[SongRecord]:
+        pending = self.writes.find(Song, song_id)
+        if pending is not None:
+            return SongRecord.from_song(pending)
+        async with self.session() as session:
+            row = (await session.execute(select(*song_record_columns).filter(Song.id == song_id))).first()
+        return to_record(row) if row else None
+
+    async def get_song_records(self, song_ids: List[int]) -> List[SongRecord]:
+        records = [SongRecord.from_song(s) for s in map(lambda i: self.writes.find(Song, i), song_ids) if s is not None]
+        missing = set(song_ids) - {r.id for r in records}
+        if missing:
+            async with self.session() as session:
+                rows = (await session.execute(select(*song_record_columns).filter(Song.id.in_(missing)))).all()
+            records += [to_record(r) for r in rows]
+        return records
+
+    async def get_song_record_by_url(self, url: str) -> Optional[SongRecord]:
+        pending = self.writes.find_by_url(Song, url)
+        if pending is not None:
+            return SongRecord.from_song(pending)
+        async with self.session() as session:
+            row = (await session.execute(select(*song_record_columns).filter(Song.url == url).limit(1))).first()
+        return to_record(row) if row else None
+
+    async def defer_stream_url(self, song_id: int, url: str):
+        self.writes.set_stream_url(song_id, url)
+        self.flush_soon()
+
+    async def get_stream_url(self, song_id: int) -> Optional[str]:
+        # Another process may have resolved it since this one loaded the song
+        async with self.session() as session:
+            return (await session.execute(select(Song.stream_url).filter(Song.id == song_id))).scalar()
+
+    async def get_song_names(self) -> List[Tuple[int, str, Optional[str], Optional[str]]]:
+        async with self.session() as session:
+            rows = (await session.execute(select(Song.id, Song.name, Song.artist, Song.url))).all()
+        pending = [(s.id, s.name, s.artist, s.url) for s in self.writes.pending(Song)]
+        return [tuple(r) for r in rows] + pending
+
+    async def get_listening_history(self, after_song: int = 0, after_entry: int = 0) \
+            -> Tuple[List[Tuple[int, Optional[str]]], List[Tuple[int, int, int]], Dict[int, int]]:
+        # Plain rows for the radio index, only songs and playlist entries newer than the given ids
+        async with self.session() as session:
+            songs = (await session.execute(
+                select(Song.id, Song.artist).filter(Song.id > after_song).order_by(Song.id)
+            )).all()
+            entries = (await session.execute(
+                select(songs_playlists.c.id, songs_playlists.c.playlist, songs_playlists.c.song)
+                .filter(songs_playlists.c.id > after_entry).order_by(songs_playlists.c.id)
+            )).all()
+            counts = dict((await session.execute(
+                select(Songstats.song_id, func.max(Songstats.play_count)).group_by(Songstats.song_id)
+            )).all())
+        for song_id, count in self.play_counts.items():
+            counts[song_id] = max(counts.get(song_id, 0), count)
+        return [tuple(r) for r in songs], [tuple(r) for r in entries], counts
+
+    async def save_player(self, player: SavedPlayer, entries: List[Tuple[int, Optional[int]]]) -> bool:
+        # Whole snapshot of one guild in a single transaction, the queue is rewritten as a block
+        async with self.session() as session:
+            await session.merge(player)
+            await session.execute(delete(SavedQueueEntry).where(SavedQueueEntry.guild_id == player.guild_id))
+            if entries:
+                await session.execute(insert(SavedQueueEntry), [
+                    {"guild_id": player.guild_id, "position": i, "song_id": song_id, "user_id": user_id}
+                    for i, (song_id, user_id) in enumerate(entries)
+                ])
+            await session.commit()
+        return True
+
+    async def save_positions(self, positions: List[Tuple[int, float]]) -> bool:
+        # Only the position of playing guilds, their queues are written by save_player when they change
+        players = SavedPlayer.__table__
+        async with self.session() as session:
+            await session.execute(
+                update(players).where(players.c.guild_id == bindparam("guild")).values(elapsed=bindparam("position")),
+                [{"guild": guild_id, "position": position} for guild_id, position in positions]
+            )
+            await session.commit()
+        return True
+
+    async def delete_player(self, guild_id: int) -> bool:
+        async with self.session() as session:
+            await session.execute(delete(SavedQueueEntry).where(SavedQueueEntry.guild_id == guild_id))
+            await session.execute(delete(SavedPlayer).where(SavedPlayer.guild_id == guild_id))
+            await session.commit()
+        return True
+
+    async def load_players(self) -> List[Tuple[SavedPlayer, List[SavedQueueEntry]]]:
+        async with self.session() as session:
+            players = (await session.scalars(select(SavedPlayer))).all()
+            entries = (await session.scalars(select(SavedQueueEntry).order_by(SavedQueueEntry.guild_id, SavedQueueEntry.position))).all()
+        by_guild: Dict[int, List[SavedQueueEntry]] = {}
+        for entry in entries:
+            by_guild.setdefault(entry.guild_id, []).append(entry)
+        return [(player, by_guild.get(player.guild_id, [])) for player in players]
+
+    async def add_playlist(self, name: str, song_ids: List[int]) -> Playlist:
+        # Songs of the playlist may still sit in the write buffer
+        await self.flush()
+        playlist = Playlist(name=name)
+        async with self.session() as session:
+            session.add(playlist)
+            await session.flush()
+            await session.execute(insert(songs_playlists), [{"playlist": playlist.id, "song": i} for i in song_ids])
+            await session.commit()
+        return playlist
+
+    async def get_playlist_by_name(self, name: str) -> Optional[Playlist]:
+        # Prefer the latest import with exactly this name over substring matches
+        async with self.session() as session:
+            playlist = (await session.scalars(
+                select(Playlist).filter(func.lower(Playlist.name) == name.lower()).order_by(Playlist.id.desc()).limit(1)
+            )).first()
+        return playlist or await self.get_by_name(Playlist, name)
+
+    async def get_playlist_songs(self, playlist_id: int) -> List[SongRecord]:
+        async with self.session() as session:
+            return [to_record(r) for r in (await session.execute(
+                select(*song_record_columns).join(songs_playlists, songs_playlists.c.song == Song.id)
+                .filter(songs_playlists.c.playlist == playlist_id)
+                .order_by(songs_playlists.c.id)
+            )).all()]
+
+    async def get_dummy(self, table: Type[T]) -> T:
         if table is Artist or table is Song:
-            return self.session.query(table).first()
+            async with self.session() as session:
+                return (await session.scalars(select(table).limit(1))).first()
         else:
             raise ValueError(f"Table {table.__tablename__} is not a valid table for this operation.")
\ No newline at end of file
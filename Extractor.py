@@ -0,0 +1,134 @@
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from yt_dlp import YoutubeDL
+
+import Metrics
+
+
+extractor_options = {
+    'workers': 4,
+    'max_pending': 32,
+    'timeout': 30.0,
+    'use_processes': False,
+    # Long lived YoutubeDL instances are rebuilt after this many extractions to cap memory growth
+    'recycle_after': 200,
+    # Audio cache downloads run on their own threads, outside workers and max_pending
+    'download_workers': 1,
+}
+
+class ExtractorBusyException(Exception):
+    def __init__(self, msg: str = "Zu viele Anfragen gleichzeitig, versuch es gleich nochmal"):
+        super().__init__(msg)
+
+class ExtractionTimeoutException(Exception):
+    def __init__(self, msg: str = "Die Suche hat zu lange gedauert"):
+        super().__init__(msg)
+
+
+# YoutubeDL is not thread safe, every worker thread (or process) keeps its own instances
+_local = threading.local()
+
+
+def _options_key(opts: dict) -> str:
+    return json.dumps(opts, sort_keys=True, default=str)
+
+
+def _get_ydl(opts: dict, recycle_after: int) -> YoutubeDL:
+    instances: Dict[str, Tuple[YoutubeDL, int]] = getattr(_local, 'instances', None)
+    if instances is None:
+        instances = _local.instances = {}
+    key = _options_key(opts)
+    ydl, uses = instances.get(key, (None, 0))
+    if ydl is not None and uses >= recycle_after:
+        ydl.close()
+        ydl = None
+    if ydl is None:
+        ydl, uses = YoutubeDL(opts), 0
+    instances[key] = (ydl, uses + 1)
+    return ydl
+
+
+def _extract_info(query: str, opts: dict, download: bool = False, recycle_after: int = 200) -> Optional[dict]:
+    # Module level so it can be pickled into a ProcessPoolExecutor
+    if download or recycle_after <= 0:
+        # Downloads use a per-song output template, an instance for them would never be reused
+        with YoutubeDL(opts) as ydl:
+            return ydl.extract_info(query, download=download)
+    return _get_ydl(opts, recycle_after).extract_info(query, download=False)
+
+
+def platform_label(query: str, download: bool = False) -> str:
+    if download:
+        return "download"
+    if query.startswith("ytsearch") or "youtu" in query:
+        return "youtube"
+    if query.startswith("scsearch") or "soundcloud" in query:
+        return "soundcloud"
+    return "other"
+
+
+class Extractor:
+    def __init__(self, workers: int = 4, max_pending: int = 32, timeout: float = 30.0, use_processes: bool = False,
+                 recycle_after: int = 200, download_workers: int = 1):
+        self.workers: int = workers
+        self.recycle_after: int = recycle_after
+        self.max_pending: int = max_pending
+        self.timeout: float = timeout
+        self.pool: Executor = ProcessPoolExecutor(max_workers=workers) if use_processes \
+            else ThreadPoolExecutor(max_workers=workers, thread_name_prefix="extractor")
+        self.pending: int = 0
+        self.lock = threading.Lock()
+        # A download with its mp3 transcode takes minutes, in the shared pool a few of them would starve /play
+        self.download_pool: Executor = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix="downloader")
+        # Held while a download runs, so its timeout doesn't start ticking while it waits for a thread
+        self.download_slots = asyncio.Semaphore(download_workers)
+
+    def _release(self, _future):
+        with self.lock:
+            self.pending -= 1
+
+    async def extract(self, query: str, opts: dict, download: bool = False, timeout: Optional[float] = None) -> Optional[dict]:
+        if download:
+            return await self.download(query, opts, timeout)
+        # Pending counts jobs that are queued or running in the pool. A timed out job keeps its slot
+        # until the worker is actually done with it, so stuck extractions can't pile up unbounded.
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise ExtractorBusyException()
+            self.pending += 1
+        try:
+            future = self.pool.submit(_extract_info, query, opts, download, self.recycle_after)
+        except RuntimeError:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+
+        started = time.perf_counter()
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise ExtractionTimeoutException()
+        finally:
+            Metrics.extraction_seconds.observe(time.perf_counter() - started, platform=platform_label(query, download))
+
+    async def download(self, query: str, opts: dict, timeout: Optional[float] = None) -> Optional[dict]:
+        async with self.download_slots:
+            future = self.download_pool.submit(_extract_info, query, opts, True, self.recycle_after)
+            started = time.perf_counter()
+            try:
+                return await asyncio.wait_for(asyncio.wrap_future(future), timeout or self.timeout)
+            except asyncio.TimeoutError:
+                future.cancel()
+                raise ExtractionTimeoutException()
+            finally:
+                Metrics.extraction_seconds.observe(time.perf_counter() - started, platform=platform_label(query, True))
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.download_pool.shutdown(wait=False, cancel_futures=True)
@@ -1,28 +1,39 @@
 import asyncio
 import datetime
 import re
-import threading
 import time
 from datetime import timedelta
 from http.client import InvalidURL
-import random
-from math import floor
-from typing import Optional
+from enum import Enum
+import unicodedata
+from collections import deque
+from math import floor, isfinite
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
 from urllib.parse import parse_qs, urlparse
 
 import discord
-import requests
 from discord import VoiceClient, app_commands, Embed, VoiceProtocol
+from discord.ext import tasks
 from discord.ext.commands import Cog, Bot
 
 from Database import *
-from yt_dlp import YoutubeDL
+from Extractor import Extractor, extractor_options
+from StreamCache import StreamCache, stream_cache_options
+from Sources import PrefetchedSource, WatchedSource, create_source, ffmpeg_process, with_offset
+from Supervisor import FFmpegLimitException, FFmpegSupervisor, supervisor_options
+from AudioCache import AudioCache, audio_cache_options
+from SongQueue import SongQueue
+from QueuePages import QueuePages, QueueView, queue_pages_options
+from Radio import RadioIndex, radio_options
+from NameIndex import NameIndex, name_index_options
+import Metrics
+from Metrics import MetricsServer, metrics_options
 import validators
 
 
 ydl_opts = {
     'default_search': 'ytsearch',
-    'format': 'bestaudio/best',
+    'format': 'bestaudio[acodec=opus]/bestaudio/best',
     'postprocessors': [{
         'key': 'FFmpegExtractAudio',
         'preferredcodec': 'mp3',
@@ -31,6 +42,8 @@ ydl_opts = {
     'outtmpl': '%(title)s.%(ext)s',
     'restrictfilenames': True,
     'noplaylist': True,
+    # Keeps player js and signature functions between restarts
+    'cachedir': 'ytdlp_cache',
     "extractor_args": {
         "youtube": {
             "player_client": ["default", "-tv_simply"]
@@ -48,6 +61,13 @@ ffmpeg_options = {
     'options': '-vn',
     'before_options': ffmpeg_before_options
 }
+ffmpeg_local_options = {
+    'options': '-vn'
+}
+audio_cache_download_timeout = 600
+# "opus" passes Opus streams through without re-encoding, "probe" asks ffprobe first, "pcm" always transcodes
+audio_mode = "opus"
+audio_bitrate = 128
 
 class UserNotInVoiceException(Exception):
     def __init__(self, msg: str = "Du bist in keinem Voice Channel"):
@@ -61,13 +81,43 @@ class BotNotInVoiceException(Exception):
     def __init__(self, msg: str = "Ich bin nicht in einem Voice Channel"):
         super().__init__(msg)
 
+class SongNotFoundException(Exception):
+    def __init__(self, msg: str = "Ich habe nichts gefunden"):
+        super().__init__(msg)
+
+
+search_cache_ttl = timedelta(days=30)
+search_cache_negative_ttl = timedelta(hours=1)
+# Words that don't change which video a search lands on
+search_filler_words = {"official", "video", "audio", "lyrics", "lyric", "hd", "hq", "mv", "visualizer", "4k"}
+query_word_re = re.compile(r"\w+")
+
+
+def normalize_query(name: str) -> str:
+    words = [w for w in query_word_re.findall(unicodedata.normalize("NFKC", name).casefold()) if w not in search_filler_words]
+    return " ".join(sorted(words)) or name.strip().casefold()
+
 class Getter:
     def __init__(self):
-        self.db: Database = Database()
-        self.yt = self.db.get_or_add_by_name(Platform, "Youtube")
-        self.sc = self.db.get_or_add_by_name(Platform, "Soundcloud")
+        self.db: Database = Database(**database_options)
+        self.yt: Optional[Platform] = None
+        self.sc: Optional[Platform] = None
         self.yt_re = re.compile(r"^((?:https?:)?\/\/)?((?:www|m)\.)?((?:youtube(?:-nocookie)?\.com|youtu.be))(\/(?:[\w\-]+\?v=|embed\/|live\/|v\/)?)([\w\-]+)(\S+)?$")
         self.sc_re = re.compile(r"^((?:https?:)?\/\/)?((?:www|m)\.)?((?:soundcloud\.com))")
+        self.extractor: Extractor = Extractor(**extractor_options)
+        self.stream_cache: StreamCache = StreamCache(**stream_cache_options)
+        self.pending_reloads: Dict[int, asyncio.Future] = {}
+        self.audio_cache: AudioCache = AudioCache(**audio_cache_options)
+        self.radio: RadioIndex = RadioIndex(**radio_options)
+        self.names: NameIndex = NameIndex(**name_index_options)
+        # Songs created while a new name index is being built, added to it before it replaces the old one
+        self.names_pending: Optional[List[Tuple[int, str, Optional[str], Optional[str]]]] = None
+
+    async def setup(self):
+        await self.db.setup()
+        self.yt = await self.db.get_or_add_by_name(Platform, "Youtube")
+        self.sc = await self.db.get_or_add_by_name(Platform, "Soundcloud")
+        self.names.load(await self.db.get_song_names())
 
     def validate_yt_url(self, url: str) -> bool:
         return self.yt_re.match(url) is not None
@@ -75,148 +125,415 @@ class Getter:
     def validate_sc_url(self, url: str) -> bool:
         return self.sc_re.match(url) is not None
 
-    def log_to_file(self, message: str):
-        with open("log.json", "w+") as f:
-            f.write(str(message))
-
-    def fetch_from_yt(self, name: str) -> Song:
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info("ytsearch:"+name, download=False)["entries"][0]
-            artist = self.db.get_or_add_by_name(Artist, info['channel'])
-            song = Song(name=info['title'], url=info['webpage_url'], duration=info['duration'], artists=artist, stream_url=info['url'], platforms=self.yt)
-            self.db.add(Song, song)
-            return song
-
-    def fetch_from_sc(self, name: str) -> Song:
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info("scsearch:"+name, download=False)["entries"][0]
-            artist = self.db.get_or_add_by_name(Artist, info['artist'])
-            song = Song(name=info['title'], url=info['webpage_url'], duration=info['duration'], artists=artist, stream_url=info['url'], platforms=self.sc)
-            self.db.add(Song, song)
-            return song
-
-    def fetch_from_url(self, url: str) -> Song:
+    def platform_for(self, url: str) -> Optional[Platform]:
+        if self.validate_yt_url(url):
+            return self.yt
+        if self.validate_sc_url(url):
+            return self.sc
+        return None
+
+    async def get_platform(self, url: str, info: dict) -> Platform:
+        # Any other site yt-dlp can play gets a Platform row of its own, Songs.platform is NOT NULL
+        platform = self.platform_for(url)
+        if platform is None:
+            name = info.get('extractor_key') or info.get('ie_key') or urlparse(url).netloc or "Unknown"
+            platform = await self.db.get_or_add_by_name(Platform, name, deferred=True)
+        return platform
+
+    def normalize_url(self, url: str) -> str:
+        if not self.validate_yt_url(url):
+            return url
         if "?v=" in url:
             urlpart = parse_qs(urlparse(url).query).get('v', [None])[0]
         else:
             urlpart = url.split("/")[-1]
+        return "https://www.youtube.com/watch?v=" + urlpart
+
+    def entry_url(self, entry: dict) -> Optional[str]:
+        # Full results carry webpage_url, flat entries only the page url in 'url'
+        url = entry.get('webpage_url') or entry.get('url')
+        if url is None and entry.get('id'):
+            url = "https://www.youtube.com/watch?v=" + entry['id']
+        return self.normalize_url(url) if url else None
+
+    async def song_from_info(self, info: dict, stream_url: str = "") -> SongRecord:
+        # Without a stream url the song is resolved lazily, right before playback or during prefetch
+        url = self.entry_url(info)
+        existing = await self.db.get_song_record_by_url(url)
+        if existing:
+            return existing
+        platform = await self.get_platform(url, info)
+        artist_name = info.get('channel') or info.get('artist') or info.get('uploader') or "Unknown"
+        artist = await self.db.get_or_add_by_name(Artist, artist_name, deferred=True)
+        song = Song(name=info['title'], url=url, duration=info.get('duration') or 0, artist=artist.name, stream_url=stream_url, platform=platform.id)
+        await self.db.defer_add(Song, song)
+        self.names.add(song.id, song.name, song.artist, song.url)
+        if self.names_pending is not None:
+            self.names_pending.append((song.id, song.name, song.artist, song.url))
+        if stream_url:
+            self.stream_cache.put(song.id, stream_url)
+        return SongRecord.from_song(song)
+
+    async def search(self, query: str) -> SongRecord:
+        # Flat search only returns metadata, no formats or player js are touched
+        opts = {**ydl_opts, 'extract_flat': True}
+        entries = [e for e in (await self.extractor.extract(query, opts) or {}).get("entries") or [] if e]
+        if not entries:
+            raise SongNotFoundException()
+        info = entries[0]
+        if not info.get('title'):
+            # Some extractors only return bare urls when flat
+            info = await self.extractor.extract(self.entry_url(info), ydl_opts)
+            return await self.song_from_info(info, info['url'])
+        return await self.song_from_info(info)
+
+    async def fetch_from_yt(self, name: str) -> SongRecord:
+        return await self.search("ytsearch:"+name)
+
+    async def fetch_from_sc(self, name: str) -> SongRecord:
+        return await self.search("scsearch:"+name)
+
+    async def fetch_from_url(self, url: str) -> SongRecord:
+        url = self.normalize_url(url)
+        db_song = await self.db.get_song_record_by_url(url)
+        if db_song:
+            return db_song
 
-        url = "https://www.youtube.com/watch?v=" + urlpart
-        print("URL: ", url)
-        if self.db.get_by_url(Song, url):
-            return self.db.get_by_url(Song, url)
-
-        with YoutubeDL(ydl_opts) as ydl:
-            artist = None
-            platform = None
-            info = ydl.extract_info(url, download=False)
-            if info is None:
-                raise InvalidURL("Invalid URL")
-
-            if self.validate_yt_url(url):
-                artist = self.db.get_or_add_by_name(Artist, info['channel'])
-                if artist is None:
-                    artist = Artist(name=info['channel'])
-                    self.db.add(Artist, artist)
-                platform = self.yt
-            elif self.validate_sc_url(url):
-                artist = self.db.get_or_add_by_name(Artist, info['artist'])
-                if artist is None:
-                    artist = Artist(name=info['artist'])
-                    self.db.add(Artist, artist)
-                platform = self.sc
-            song = Song(name=info['title'], url=info['webpage_url'], duration=info['duration'], artists=artist, stream_url=info['url'], platforms=platform)
-            self.db.add(Song, song)
-            return song
-
-    def get_song_by_name(self, name: str) -> Song:
-        db_song = self.db.get_by_name(Song, name)
+        info = await self.extractor.extract(url, ydl_opts)
+        if info is None:
+            raise InvalidURL("Invalid URL")
+        return await self.song_from_info(info, info['url'])
+
+    async def search_remote(self, name: str) -> SongRecord:
+        query = normalize_query(name)
+        cached = await self.db.get_search_cache(query)
+        if cached is not None:
+            age = datetime.datetime.now() - cached.created
+            if cached.song_id is None and age < search_cache_negative_ttl:
+                raise SongNotFoundException()
+            if cached.song_id is not None and age < search_cache_ttl:
+                song = await self.db.get_song_record(cached.song_id)
+                if song:
+                    return song
+
+        try:
+            song = await self.fetch_from_yt(name)
+        except SongNotFoundException:
+            await self.db.put_search_cache(query, None)
+            raise
+        await self.db.put_search_cache(query, song.id)
+        return song
+
+    async def get_song_by_name(self, name: str) -> SongRecord:
+        db_song = await self.db.search_song(name)
         if db_song:
             return db_song
         else:
-            return self.fetch_from_yt(name)
+            return await self.search_remote(name)
 
 
-    def get_songs_by_name(self, names: List[str]) -> List[Song]:
-        songs: List[Song] = []
+    async def get_songs_by_name(self, names: List[str]) -> List[SongRecord]:
+        songs: List[SongRecord] = []
         for name in names:
-            db_song = self.db.get_by_name(Song, name)
+            db_song = await self.db.search_song(name)
             if db_song:
                 songs.append(db_song)
             else:
-                song = self.fetch_from_yt(name)
+                song = await self.search_remote(name)
                 songs.append(song)
         return songs
 
-    def get_song_by_url(self, url: str) -> Song:
-        db_song = self.db.get_by_url(Song, url)
+    async def get_song_by_url(self, url: str) -> SongRecord:
+        db_song = await self.db.get_song_record_by_url(url)
         if db_song:
             return db_song
         else:
-            return self.fetch_from_url(url)
-
-    def reload_stream_url(self, song: Song) -> Song:
-        s: Song = song
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(song.url, download=False)
-            s.stream_url = info['url']
-            self.db.update(Song, s)
-        return s
-
-    def get_stream_url_with_time(self, song: Song, time: int) -> Song:
-        s: Song = song
-        with YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(song.url, download=False)
-            s.stream_url = info['url'] + "?p=" + str(floor(time))
-        return s
-
-
+            return await self.fetch_from_url(url)
+
+    async def expand_playlist(self, url: str) -> Tuple[str, List[dict]]:
+        # Flat extraction only lists the entries, no formats or stream urls are resolved here
+        opts = {**ydl_opts, 'extract_flat': 'in_playlist', 'noplaylist': False}
+        info = await self.extractor.extract(url, opts, timeout=playlist_timeout)
+        if info is None:
+            raise InvalidURL("Invalid URL")
+        entries = [e for e in info.get('entries') or [] if e and self.entry_url(e)]
+        return info.get('title') or url, entries[:playlist_max_entries]
+
+    async def import_playlist(self, name: str, entries: List[dict], on_song: Callable[[SongRecord], Awaitable[None]]) -> List[SongRecord]:
+        semaphore = asyncio.Semaphore(playlist_import_concurrency)
+
+        async def resolve(entry: dict) -> Optional[SongRecord]:
+            async with semaphore:
+                try:
+                    if entry.get('title'):
+                        return await self.song_from_info(entry)
+                    return await self.get_song_by_url(self.entry_url(entry))
+                except Exception as e:
+                    print(f"Could not import {self.entry_url(entry)}: {e}")
+                    return None
+
+        # Entries resolve concurrently but reach the queue in playlist order
+        urls = [self.entry_url(entry) for entry in entries]
+        tasks: Dict[str, asyncio.Future] = {}
+        for url, entry in zip(urls, entries):
+            if url not in tasks:
+                tasks[url] = asyncio.ensure_future(resolve(entry))
+        songs: List[SongRecord] = []
+        try:
+            for url in urls:
+                song = await tasks[url]
+                if song is not None:
+                    songs.append(song)
+                    await on_song(song)
+        finally:
+            for task in tasks.values():
+                task.cancel()
+
+        if songs:
+            await self.db.add_playlist(name, [song.id for song in songs])
+        return songs
 
-class Manager(Cog):
-    def __init__(self, bot: Bot):
-        self.bot: Bot = bot
-        self.queue: List[Song] = []
-        self.current_song: Song = None
-        self.voice_client: VoiceClient = None
-        self.getter: Getter = Getter()
-        self.tree = bot.tree
+    async def _reload_stream_url(self, song: SongRecord) -> str:
+        Metrics.stream_url_refreshes.inc()
+        info = await self.extractor.extract(song.url, ydl_opts)
+        await self.db.defer_stream_url(song.id, info['url'])
+        self.stream_cache.put(song.id, info['url'])
+        return info['url']
+
+    async def reload_stream_url(self, song: SongRecord) -> str:
+        # Prefetch and playback may ask for the same song at once, share a single extraction
+        task = self.pending_reloads.get(song.id)
+        if task is None:
+            task = asyncio.ensure_future(self._reload_stream_url(song))
+            self.pending_reloads[song.id] = task
+            task.add_done_callback(lambda _: self.pending_reloads.pop(song.id, None))
+        return await asyncio.shield(task)
+
+    def cached_stream_url(self, song: SongRecord) -> Optional[str]:
+        return self.stream_cache.get(song.id)
+
+    async def shared_stream_url(self, song: SongRecord) -> Optional[str]:
+        # Written by an earlier run or by another shard, records don't carry stream urls themselves
+        url = await self.db.get_stream_url(song.id)
+        if not self.stream_cache.is_fresh(url):
+            return None
+        self.stream_cache.put(song.id, url)
+        return url
+
+    async def get_stream_url(self, song: SongRecord) -> str:
+        url = self.cached_stream_url(song) or await self.shared_stream_url(song)
+        if url is None:
+            url = await self.reload_stream_url(song)
+        return url
+
+    async def get_playable(self, song: SongRecord) -> Tuple[str, dict]:
+        path = await asyncio.get_running_loop().run_in_executor(None, self.audio_cache.get, song.id)
+        if path:
+            return path, ffmpeg_local_options
+        return await self.get_stream_url(song), ffmpeg_options
+
+    async def record_play(self, song: SongRecord) -> int:
+        play_count = await self.db.record_play(song.id)
+        loop = asyncio.get_running_loop()
+        if self.audio_cache.wants(song.id, play_count) and await loop.run_in_executor(None, self.audio_cache.claim, song.id):
+            asyncio.ensure_future(self.download_song(song))
+        return play_count
+
+    async def download_song(self, song: SongRecord) -> bool:
+        opts = {**ydl_opts, 'outtmpl': self.audio_cache.template_for(song.id)}
+        loop = asyncio.get_running_loop()
+        try:
+            await self.extractor.extract(song.url, opts, download=True, timeout=audio_cache_download_timeout)
+            # Waits for the lock other shards hold while they rescan, never on the event loop
+            return await loop.run_in_executor(None, self.audio_cache.add, song.id)
+        except Exception as e:
+            print(f"Could not cache {song.name}: {e}")
+            return False
+        finally:
+            await loop.run_in_executor(None, self.audio_cache.release, song.id)
+
+    async def refresh_radio(self, full: bool = False):
+        loop = asyncio.get_running_loop()
+        if full:
+            # Built from scratch and swapped in. Other shards reserve ids in their own blocks, so their songs
+            # can land below the incremental watermark, a full rebuild picks those up as well.
+            await self.rebuild_names()
+            radio = RadioIndex(**radio_options)
+            await loop.run_in_executor(None, radio.update, *await self.db.get_listening_history(), True)
+            self.radio = radio
+            return
+        songs, entries, counts = await self.db.get_listening_history(self.radio.last_song, self.radio.last_entry)
+        # Pure Python scoring, kept off the event loop
+        await loop.run_in_executor(None, self.radio.update, songs, entries, counts)
+
+    async def rebuild_names(self):
+        names = NameIndex(**name_index_options)
+        self.names_pending = []
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, names.load, await self.db.get_song_names())
+            names.load(self.names_pending)
+            self.names = names
+        finally:
+            self.names_pending = None
+
+    async def get_radio_song(self, seeds: List[int], exclude: set) -> Optional[SongRecord]:
+        song_id = self.radio.pick(seeds, exclude)
+        if song_id is None:
+            return None
+        return await self.db.get_song_record(song_id)
+
+    async def close(self):
+        self.extractor.shutdown()
+        await self.db.close()
+
+
+
+playlist_timeout = 120
+playlist_max_entries = 500
+playlist_import_concurrency = 4
+
+player_idle_timeout = 300
+stream_refresh_interval = 60
+radio_refresh_interval = 300
+# Every this many refreshes the whole radio index is rescored with fresh play counts
+radio_full_rebuild_every = 12
+# Recently played songs autoplay seeds from and won't repeat
+radio_history = 50
+# Radio picks tried per advance before autoplay gives up, the worker has other events to handle
+radio_attempts = 5
+# Seconds between writes of changed queues to the database
+queue_journal_interval = 5
+# Open the next song's FFmpeg process this many seconds before the current one ends
+prefetch_lead = 15
+# 20ms frames buffered ahead, 150 frames are 3 seconds
+prefetch_frames = 150
+# A prefetched stream that hasn't buffered by then is thrown away and opened again
+prefetch_fill_timeout = 5
+# Seconds between checks for stalled, orphaned and leaked FFmpeg processes
+ffmpeg_supervise_interval = 5
+
+
+# Longer than any stream worth seeking in, keeps parsed values far inside timedelta's range
+max_timestamp = 7 * 24 * 3600
+
+
+def parse_timestamp(value: str) -> Optional[Tuple[float, bool]]:
+    # "90", "1:30" or "1:02:03", a leading + or - makes it relative to the current position
+    value = value.strip()
+    relative = value[:1] in "+-"
+    sign = -1 if value.startswith("-") else 1
+    parts = value.lstrip("+-").split(":")
+    if not 1 <= len(parts) <= 3:
+        return None
+    try:
+        seconds = 0.0
+        for part in parts:
+            seconds = seconds * 60 + float(part)
+    except ValueError:
+        return None
+    # float() takes "inf", "nan" and "1e999", none of which FFmpeg or timedelta can use
+    if not isfinite(seconds) or seconds > max_timestamp:
+        return None
+    return sign * seconds, relative
+
+
+class PlayerState(Enum):
+    IDLE = "idle"
+    RESOLVING = "resolving"
+    PLAYING = "playing"
+    STOPPING = "stopping"
+
+
+class Player:
+    def __init__(self, manager: "Manager", guild_id: int):
+        self.manager: Manager = manager
+        self.bot: Bot = manager.bot
+        self.getter: Getter = manager.getter
+        self.supervisor: FFmpegSupervisor = manager.supervisor
+        self.guild_id: int = guild_id
+        self.queue: SongQueue = SongQueue()
+        self.pages: QueuePages = QueuePages(self.queue, **queue_pages_options)
+        self.current_song: Optional[SongRecord] = None
+        self.voice_client: Optional[VoiceClient] = None
         self.song_playing_since: Optional[float] = None
+        self.last_active: float = time.time()
+        self.prefetched: Optional[Tuple[int, PrefetchedSource, asyncio.Future]] = None
+        self.prefetch_handle: Optional[asyncio.TimerHandle] = None
+        self.song_ended_at: Optional[float] = None
+        self.last_gap: Optional[float] = None
+        self.state: PlayerState = PlayerState.IDLE
+        # Bumped whenever a source is started or abandoned, events carrying an older value are stale
+        self.generation: int = 0
+        self.events: asyncio.Queue = asyncio.Queue()
+        self.worker: Optional[asyncio.Task] = None
+        self.closed: bool = False
+        # perf_counter of the play command that woke an idle player, cleared once audio starts
+        self.requested_at: Optional[float] = None
+        self.autoplay: bool = False
+        self.history: Deque[int] = deque(maxlen=radio_history)
+        # Song and position of the last /stop, picked up again by /resume
+        self.resume_point: Optional[Tuple[SongRecord, float]] = None
+        # Set on every change that the queue journal has not written yet
+        self.dirty: bool = False
+        # Stall restarts of the current song, it is skipped once the supervisor's limit is reached
+        self.restarts: int = 0
+
+    def touch(self):
+        self.last_active = time.time()
+
+    def is_idle(self) -> bool:
+        return self.voice_client is None and time.time() - self.last_active > player_idle_timeout
 
     def next(self):
-        if len(self.queue) > 0:
-            self.current_song = self.queue.pop(0)
-        else:
-            self.current_song = None
+        self.current_song = self.queue.popleft()
+
+    def add_to_queue(self, song: SongRecord, user_id: Optional[int] = None) -> bool:
+        self.queue.append(song, user_id)
+        self.queue_changed()
+        return True
 
-    def add_to_queue(self, song: Song) -> bool:
-        self.queue.append(song)
+    def add_next(self, song: SongRecord, user_id: Optional[int] = None) -> bool:
+        self.queue.appendleft(song, user_id)
+        self.queue_changed()
         return True
 
-    def remove_from_queue(self, song: Song) -> bool:
-        if song in self.queue:
-            self.queue.remove(song)
+    def remove_from_queue(self, song: SongRecord) -> bool:
+        if self.queue.remove_song(song):
+            self.queue_changed()
             return True
         else:
             return False
 
+    def shuffle_queue(self):
+        self.queue.shuffle()
+        self.queue_changed()
+
     def clear_queue(self) -> bool:
         self.queue.clear()
+        self.queue_changed()
         return True
 
-    def duration(self):
-        i = 0
-        for song in self.queue:
-            i += song.duration
-        return i
+    def queue_changed(self):
+        self.dirty = True
+        # A prefetched source is only useful for the song at the head of the queue
+        head = self.queue.peek()
+        if self.prefetched and (head is None or self.prefetched[0] != head.id):
+            self.drop_prefetched()
+        due = self.prefetch_handle is not None and self.prefetch_handle.when() <= self.bot.loop.time()
+        if self.queue and not self.prefetched and due:
+            self.bot.loop.create_task(self.prefetch_next_source())
+
+    def duration(self) -> float:
+        return self.queue.duration
 
-    def get_queue(self) -> List[Song]:
+    def get_queue(self) -> SongQueue:
         return self.queue
 
-    def get_current_song(self) -> Optional[Song]:
+    def get_current_song(self) -> Optional[SongRecord]:
         return self.current_song
 
     def is_playing(self) -> bool:
-        if self.voice_client and self.voice_client.channel and self.voice_client.source and self.current_song:
+        if self.voice_client and self.current_song and self.state in (PlayerState.RESOLVING, PlayerState.PLAYING):
             return True
         return False
 
@@ -226,12 +543,28 @@ class Manager(Cog):
     def is_connected(self) -> bool:
         return self.voice_client.is_connected()
 
+    def reset(self):
+        self.voice_client = None
+        self.queue.clear()
+        self.current_song = None
+        self.song_playing_since = None
+        self.state = PlayerState.IDLE
+        self.generation += 1
+        self.dirty = True
+        self.resume_point = None
+        self.cancel_prefetch()
+
+    def close(self):
+        self.closed = True
+        self.cancel_prefetch()
+        if self.worker:
+            self.worker.cancel()
+            self.worker = None
+
     async def _disconnect(self) -> bool:
         if self.voice_client.is_connected():
             await self.voice_client.disconnect()
-            self.voice_client = None
-            self.queue.clear()
-            self.current_song = None
+            self.reset()
             return True
         else:
             raise BotNotInVoiceException()
@@ -251,201 +584,699 @@ class Manager(Cog):
             else:
                 return True
 
-    async def set_status(self):
-        if self.current_song:
-            await self.bot.change_presence(activity=discord.Game(name=self.current_song.name))
+    def send(self, event: str, generation: Optional[int] = None, payload=None):
+        if self.closed:
+            return
+        if self.worker is None or self.worker.done():
+            self.worker = self.bot.loop.create_task(self.run())
+        self.events.put_nowait((event, self.generation if generation is None else generation, payload))
+
+    def start(self, requested_at: Optional[float] = None):
+        self.touch()
+        if self.state is PlayerState.IDLE:
+            self.requested_at = requested_at
+            self.send("start")
+
+    def resume(self, song: SongRecord, offset: float):
+        self.touch()
+        self.send("resume", payload=(song, offset))
+
+    def skip(self) -> bool:
+        self.touch()
+        if self.state is not PlayerState.PLAYING:
+            return False
+        # Carries the generation of the song the user wanted to skip, repeated skips of it collapse into one
+        self.send("skip")
+        return True
+
+    def stop(self):
+        self.touch()
+        self.send("stop")
+
+    def seek(self, offset: float) -> bool:
+        self.touch()
+        if self.state is not PlayerState.PLAYING:
+            return False
+        self.send("seek", payload=max(0.0, offset))
+        return True
+
+    def stalled(self) -> bool:
+        source = self.voice_client.source if self.voice_client else None
+        if self.state is not PlayerState.PLAYING or not isinstance(source, WatchedSource):
+            return False
+        return self.voice_client.is_playing() and time.monotonic() - source.last_read > self.supervisor.stall_timeout
+
+    def restart(self):
+        source = self.voice_client.source
+        self.restarts += 1
+        if self.restarts > self.supervisor.max_restarts:
+            print(f"Skipping {self.current_song.name} after {self.restarts - 1} restarts")
+            self.send("skip")
         else:
-            await self.bot.change_presence(activity=discord.Game(name="Nix"))
+            print(f"Restarting stalled {self.current_song.name} at {source.position():.1f}s")
+            Metrics.ffmpeg_restarts.inc()
+            self.send("restart", payload=source.position())
+        # The audio thread is blocked reading the dead stream, killing FFmpeg lets it finish.
+        # Its after callback is queued behind the event above and is stale by then.
+        process = ffmpeg_process(source)
+        if process is not None:
+            self.supervisor.kill(process, "stall")
+
+    def _after(self, generation: int, error=None):
+        # Runs on discord's audio thread
+        self.song_ended_at = time.perf_counter()
+        self.bot.loop.call_soon_threadsafe(self.send, "finished", generation, error)
+
+    async def run(self):
+        while True:
+            event, generation, payload = await self.events.get()
+            try:
+                if event == "start":
+                    if self.state is PlayerState.IDLE:
+                        await self.advance()
+                elif event == "resume":
+                    if self.state is PlayerState.IDLE:
+                        self.current_song, offset = payload
+                        if not await self.play_current(offset):
+                            await self.advance()
+                elif event == "finished":
+                    if generation != self.generation:
+                        continue
+                    if payload:
+                        print(f"Error playing song: {payload}")
+                    await self.advance()
+                elif event == "skip":
+                    if generation != self.generation or self.state is not PlayerState.PLAYING:
+                        continue
+                    self.halt()
+                    await self.advance()
+                elif event == "seek":
+                    if generation != self.generation or self.state is not PlayerState.PLAYING:
+                        continue
+                    self.halt()
+                    if not await self.play_current(payload):
+                        await self.advance()
+                elif event == "restart":
+                    if generation != self.generation or self.state is not PlayerState.PLAYING:
+                        continue
+                    self.halt()
+                    if self.restarts > 1 and self.current_song.id not in self.getter.audio_cache.entries:
+                        # Stalled again, the stream url itself is probably dead
+                        self.getter.stream_cache.invalidate(self.current_song.id)
+                        await self.getter.reload_stream_url(self.current_song)
+                    if not await self.play_current(payload):
+                        await self.advance()
+                elif event == "stop":
+                    if self.current_song and self.state is PlayerState.PLAYING:
+                        self.resume_point = (self.current_song, self.elapsed())
+                    self.queue.clear()
+                    self.halt()
+                    self.current_song = None
+                    self.state = PlayerState.IDLE
+                    self.dirty = True
+                    self.cancel_prefetch()
+                    await self.manager.set_status()
+            except FFmpegLimitException as e:
+                # Nothing was skipped, the song waits at the front until a slot is free
+                print(f"Player {self.guild_id} waits for FFmpeg: {e}")
+                if self.current_song:
+                    self.queue.appendleft(self.current_song)
+                    self.current_song = None
+                    self.queue_changed()
+                self.state = PlayerState.IDLE
+                self.bot.loop.call_later(self.supervisor.acquire_timeout, self.start)
+            except Exception as e:
+                print(f"Player {self.guild_id} failed on {event}: {e}")
+                self.state = PlayerState.IDLE
+
+    def halt(self):
+        self.state = PlayerState.STOPPING
+        # The stopped source still fires its after callback, make sure it is ignored
+        self.generation += 1
+        self.song_playing_since = None
+        if self.voice_client and self.voice_client.is_playing():
+            self.voice_client.stop()
 
-    def run_play(self, source):
-        self.song_playing_since = time.time()
-        self.voice_client.play(source, after=lambda e: self.bot.loop.call_soon_threadsafe(self._play), bitrate=256, signal_type="music")
+    def elapsed(self) -> float:
+        return time.time() - self.song_playing_since if self.song_playing_since else 0.0
 
-    def _play(self, error=None):
+    async def advance(self):
         self.song_playing_since = None
-        if error:
-            print(f"Error playing song: {error}")
+        # Radio picks that could not be played, never picked again during this advance
+        failed = set()
+        while True:
+            self.next()
+            from_radio = False
+            if self.current_song is None and self.autoplay and self.history and len(failed) < radio_attempts:
+                self.current_song = await self.getter.get_radio_song(list(reversed(self.history)), set(self.history) | failed)
+                from_radio = True
+            if self.current_song is None or self.voice_client is None:
+                self.current_song = None
+                self.state = PlayerState.IDLE
+                self.cancel_prefetch()
+                self.bot.loop.create_task(self.manager.set_status())
+                return
+            self.restarts = 0
+            if await self.play_current():
+                self.history.append(self.current_song.id)
+                await self.getter.record_play(self.current_song)
+                return
+            if from_radio:
+                failed.add(self.current_song.id)
+
+    async def play_current(self, offset: float = 0) -> bool:
+        self.state = PlayerState.RESOLVING
+        self.dirty = True
+        try:
+            source = await self.take_prefetched(self.current_song) if offset <= 0 else None
+            if source is None:
+                stream, options = await self.getter.get_playable(self.current_song)
+                await self.supervisor.acquire()
+                source = await create_source(stream, with_offset(options, offset), audio_mode, audio_bitrate)
+                self.supervisor.track(self.guild_id, source)
+        except FFmpegLimitException:
+            raise
+        except Exception as e:
+            print(f"Could not play {self.current_song.name}: {e}")
+            return False
+        if self.voice_client is None:
+            source.cleanup()
+            return False
 
-        self.next()
-        if self.current_song is None:
+        self.generation += 1
+        generation = self.generation
+        source = WatchedSource(source, offset)
+        try:
+            self.voice_client.play(source, after=lambda e: self._after(generation, e), bitrate=256, signal_type="music")
+        except Exception:
+            source.cleanup()
+            raise
+        self.song_playing_since = time.time() - offset
+        self.state = PlayerState.PLAYING
+        if self.song_ended_at is not None:
+            self.last_gap = time.perf_counter() - self.song_ended_at
+            self.song_ended_at = None
+            Metrics.transition_gap_seconds.observe(self.last_gap)
+        if self.requested_at is not None:
+            Metrics.first_audio_seconds.observe(time.perf_counter() - self.requested_at)
+            self.requested_at = None
+
+        self.schedule_prefetch()
+        self.bot.loop.create_task(self.manager.set_status())
+        self.bot.loop.create_task(self.prefetch_stream_urls())
+        return True
+
+    def ffmpeg_processes(self) -> List["subprocess.Popen"]:
+        sources = [self.voice_client.source if self.voice_client else None, self.prefetched[1] if self.prefetched else None]
+        return [p for p in map(ffmpeg_process, sources) if p is not None]
+
+    def snapshot(self) -> Tuple[SavedPlayer, List[Tuple[int, Optional[int]]]]:
+        elapsed = self.elapsed() if self.current_song and self.state is PlayerState.PLAYING else None
+        saved = SavedPlayer(guild_id=self.guild_id, channel_id=self.voice_client.channel.id,
+                            song_id=self.current_song.id if elapsed is not None else None, elapsed=elapsed, fair=self.queue.fair)
+        entries = [(entry.song.id, entry.user_id) for entry in self.queue.iter_entries()]
+        if self.current_song and elapsed is None:
+            # Still resolving, replay it from the start
+            entries.insert(0, (self.current_song.id, None))
+        return saved, entries
+
+    def schedule_prefetch(self):
+        if self.prefetch_handle:
+            self.prefetch_handle.cancel()
+        delay = max(0.0, (self.current_song.duration or 0) - self.elapsed() - prefetch_lead) if self.current_song else 0.0
+        self.prefetch_handle = self.bot.loop.call_later(delay, lambda: self.bot.loop.create_task(self.prefetch_next_source()))
+
+    async def prefetch_next_source(self):
+        song = self.queue.peek()
+        if song is None or not self.voice_client:
+            return
+        if self.prefetched and self.prefetched[0] == song.id:
+            return
+        try:
+            stream, options = await self.getter.get_playable(song)
+        except Exception as e:
+            print(f"Could not prefetch {song.name}: {e}")
             return
+        # Prefetching only saves a moment, it never takes the last slots from a guild that wants to play
+        if self.queue.peek() is not song or not self.supervisor.can_prefetch():
+            return
+        source = PrefetchedSource(await create_source(stream, options, audio_mode, audio_bitrate), prefetch_frames)
+        self.supervisor.track(self.guild_id, source)
+        self.drop_prefetched()
+        self.prefetched = (song.id, source, self.bot.loop.run_in_executor(None, source.fill))
+
+    async def take_prefetched(self, song: SongRecord) -> Optional[PrefetchedSource]:
+        if self.prefetched is None:
+            return None
+        song_id, source, future = self.prefetched
+        self.prefetched = None
+        if song_id != song.id:
+            source.cleanup()
+            return None
+        try:
+            await asyncio.wait_for(future, prefetch_fill_timeout)
+        except Exception as e:
+            # Killing FFmpeg also ends a fill that is still blocked in read
+            print(f"Prefetched source of {song.name} unusable, opening a new one: {e!r}")
+            source.cleanup()
+            return None
+        return source
+
+    def drop_prefetched(self):
+        if self.prefetched:
+            _, source, _ = self.prefetched
+            self.prefetched = None
+            source.cleanup()
+
+    def cancel_prefetch(self):
+        if self.prefetch_handle:
+            self.prefetch_handle.cancel()
+            self.prefetch_handle = None
+        self.drop_prefetched()
+
+    async def prefetch_stream_urls(self):
+        cache = self.getter.stream_cache
+        for song in self.queue.head(cache.prefetch):
+            if song.id in self.getter.audio_cache.entries:
+                continue
+            try:
+                if cache.needs_refresh(song.id, horizon=stream_refresh_interval):
+                    await self.getter.shared_stream_url(song)
+                if cache.needs_refresh(song.id, horizon=stream_refresh_interval):
+                    await self.getter.reload_stream_url(song)
+            except Exception as e:
+                print(f"Could not refresh stream url of {song.name}: {e}")
 
-        print("Playing1:", self.current_song)
-        stream = self.current_song.stream_url
-        head = requests.head(stream, allow_redirects=True)
-        if head.status_code == 403:
-            self.current_song = self.getter.reload_stream_url(self.current_song)
-            print("Reloaded URL")
-        source = discord.FFmpegPCMAudio(self.current_song.stream_url, **ffmpeg_options)
-        self.bot.loop.create_task(self.set_status())
-        threading.Thread(target=self.run_play, args=(source, )).start()
 
+class Manager(Cog):
+    def __init__(self, bot: Bot):
+        self.bot: Bot = bot
+        self.players: Dict[int, Player] = {}
+        self.getter: Getter = Getter()
+        self.supervisor: FFmpegSupervisor = FFmpegSupervisor(**supervisor_options)
+        self.tree = bot.tree
+        # Every shard process gets its own port, counted up from the configured one
+        shard = min(getattr(bot, 'shard_ids', None) or [0])
+        self.metrics_server: MetricsServer = MetricsServer(**{**metrics_options, 'port': metrics_options['port'] + shard})
+        Metrics.ffmpeg_processes.collect = lambda: {(): self.supervisor.live()}
+        Metrics.ffmpeg_cpu_seconds.collect = lambda: self.ffmpeg_usage(0)
+        Metrics.ffmpeg_rss_bytes.collect = lambda: self.ffmpeg_usage(1)
+        Metrics.queue_depth.collect = lambda: {(("guild", str(g)),): len(p.queue) for g, p in list(self.players.items())}
+
+    def ffmpeg_usage(self, field: int) -> Dict[Metrics.Labels, float]:
+        return {(("guild", str(g)), ("pid", str(pid))): usage[field] for (g, pid), usage in self.supervisor.usage().items()}
+
+    def get_player(self, guild_id: int) -> Player:
+        player = self.players.get(guild_id)
+        if player is None:
+            player = Player(self, guild_id)
+            self.players[guild_id] = player
+        player.touch()
+        return player
+
+    def get_connected_player(self, interaction: discord.Interaction) -> Player:
+        player = self.players.get(interaction.guild_id)
+        if not player or not player.voice_client:
+            raise BotNotInVoiceException()
+        if not interaction.user.voice or not interaction.user.voice.channel == player.voice_client.channel:
+            raise DifferentVoiceChannelException()
+        player.touch()
+        return player
+
+    def evict_player(self, guild_id: int):
+        player = self.players.pop(guild_id, None)
+        if player:
+            player.close()
+            self.bot.loop.create_task(self.getter.db.delete_player(guild_id))
+
+    @tasks.loop(seconds=60)
+    async def evict_idle_players(self):
+        for guild_id in [g for g, p in self.players.items() if p.is_idle()]:
+            self.evict_player(guild_id)
+
+    @tasks.loop(seconds=stream_refresh_interval)
+    async def refresh_stream_urls(self):
+        self.getter.stream_cache.prune()
+        for player in list(self.players.values()):
+            if player.voice_client and player.queue:
+                await player.prefetch_stream_urls()
+
+    @tasks.loop(seconds=queue_journal_interval)
+    async def journal_players(self):
+        dirty = [p for p in self.players.values() if p.dirty]
+        playing = [(p.guild_id, p.elapsed()) for p in self.players.values()
+                   if not p.dirty and p.state is PlayerState.PLAYING and p.voice_client]
+        if playing:
+            try:
+                await self.getter.db.save_positions(playing)
+            except Exception as e:
+                print(f"Could not save playback positions: {e}")
+        if not dirty:
+            return
+        # Queued songs may only exist in the write buffer yet
+        await self.getter.db.flush()
+        for player in dirty:
+            player.dirty = False
+            try:
+                if player.voice_client and player.voice_client.channel:
+                    await self.getter.db.save_player(*player.snapshot())
+                else:
+                    await self.getter.db.delete_player(player.guild_id)
+            except Exception as e:
+                player.dirty = True
+                print(f"Could not save queue of {player.guild_id}: {e}")
+
+    async def restore_player(self, saved: SavedPlayer, entries: List[SavedQueueEntry]):
+        player = self.get_player(saved.guild_id)
+        if not player.voice_client:
+            channel = self.bot.get_channel(saved.channel_id)
+            if not isinstance(channel, discord.VoiceChannel) or not any(not m.bot for m in channel.members):
+                await self.getter.db.delete_player(saved.guild_id)
+                return
+            await player.connect_to_channel(channel)
+
+        ids = [e.song_id for e in entries] + ([saved.song_id] if saved.song_id else [])
+        songs = {song.id: song for song in await self.getter.db.get_song_records(ids)}
+        player.queue.set_fair(bool(saved.fair))
+        for entry in entries:
+            if entry.song_id in songs:
+                player.queue.append(songs[entry.song_id], entry.user_id)
+        player.queue_changed()
+
+        current = songs.get(saved.song_id)
+        offset = saved.elapsed if current and saved.elapsed else 0
+        if current and 0 < offset < (current.duration or 0):
+            player.resume(current, offset)
+        else:
+            if current:
+                player.queue.appendleft(current)
+            player.start()
+
+    @tasks.loop(seconds=ffmpeg_supervise_interval)
+    async def supervise_ffmpeg(self):
+        players = list(self.players.values())
+        await self.supervisor.sweep({p.guild_id: p.ffmpeg_processes() for p in players})
+        for player in players:
+            if player.stalled():
+                player.restart()
+
+    @tasks.loop(seconds=radio_refresh_interval)
+    async def refresh_radio(self):
+        try:
+            await self.getter.refresh_radio(full=self.refresh_radio.current_loop % radio_full_rebuild_every == 0)
+        except Exception as e:
+            print(f"Could not refresh radio index: {e}")
 
-    def get_voice_client_on_reload(self):
-        vcs = self.bot.voice_clients
-        return vcs[0] if vcs else None
+    async def set_status(self):
+        playing = [p.current_song for p in self.players.values() if p.current_song]
+        if len(playing) == 1:
+            await self.bot.change_presence(activity=discord.Game(name=playing[0].name))
+        elif playing:
+            await self.bot.change_presence(activity=discord.Game(name=f"Musik auf {len(playing)} Servern"))
+        else:
+            await self.bot.change_presence(activity=discord.Game(name="Nix"))
 
     async def cog_load(self):
-        if not self.voice_client and self.get_voice_client_on_reload():
-            self.voice_client = self.get_voice_client_on_reload()
-            self.current_song = self.getter.db.get_dummy(Song)
+        await self.getter.setup()
+        for voice_client in self.bot.voice_clients:
+            player = self.get_player(voice_client.guild.id)
+            if not player.voice_client:
+                player.voice_client = voice_client
+        for saved, entries in await self.getter.db.load_players():
+            if self.bot.get_guild(saved.guild_id) is None:
+                # Belongs to another shard, that process restores it
+                continue
+            try:
+                await self.restore_player(saved, entries)
+            except Exception as e:
+                print(f"Could not restore queue of {saved.guild_id}: {e}")
+        self.evict_idle_players.start()
+        self.refresh_stream_urls.start()
+        self.journal_players.start()
+        self.refresh_radio.start()
+        self.supervise_ffmpeg.start()
+        await self.metrics_server.start()
+
+    async def cog_unload(self):
+        self.journal_players.cancel()
+        # Last snapshot before the players stop, a reload resumes exactly here
+        for player in self.players.values():
+            player.dirty = True
+        await self.journal_players()
+        for player in self.players.values():
+            player.close()
+            player.halt()
+        self.evict_idle_players.cancel()
+        self.refresh_stream_urls.cancel()
+        self.refresh_radio.cancel()
+        self.supervise_ffmpeg.cancel()
+        self.supervisor.close()
+        await self.metrics_server.stop()
+        await self.getter.close()
 
 
     @Cog.listener()
     async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
-        if self.voice_client and self.voice_client.channel:
-            if len(self.voice_client.channel.members) == 1:
-                await self._disconnect()
+        player = self.players.get(member.guild.id)
+        if player is None:
+            return
+        if player.voice_client and player.voice_client.channel:
+            if len(player.voice_client.channel.members) == 1:
+                await player._disconnect()
                 await self.set_status()
         if member == self.bot.user:
             if not after.channel:
-                self.voice_client = None
-                self.current_song = None
-                self.queue.clear()
+                player.reset()
                 await self.set_status()
 
     @app_commands.command(name="play", description="Play a song")
     @app_commands.describe(song="Name or URL of the song")
     async def play(self, interaction: discord.Interaction, *, song: str):
+        requested_at = time.perf_counter()
         await interaction.response.defer()
 
         if not interaction.user.voice:
             raise UserNotInVoiceException()
-        if not self.voice_client:
-            await self.connect_to_channel(interaction.user.voice.channel)
-        if not interaction.user.voice.channel == self.voice_client.channel:
+        player = self.get_player(interaction.guild_id)
+        if not player.voice_client:
+            await player.connect_to_channel(interaction.user.voice.channel)
+        if not interaction.user.voice.channel == player.voice_client.channel:
             raise DifferentVoiceChannelException()
 
         if validators.url(song):
-            song: Song = self.getter.fetch_from_url(song)
+            song: SongRecord = await self.getter.fetch_from_url(song)
         else:
-            song: Song = self.getter.get_song_by_name(song)
+            song: SongRecord = await self.getter.get_song_by_name(song)
 
-        self.add_to_queue(song)
+        player.add_to_queue(song, interaction.user.id)
         song_name = song.name
-        if not self.is_playing():
-            self._play()
+        # Answer first, the stream url of a fresh search result is only resolved by the player
         await interaction.followup.send(f"{song_name} zur Warteschlange hinzugefügt")
+        if not player.is_playing():
+            player.start(requested_at)
+        else:
+            self.bot.loop.create_task(player.prefetch_stream_urls())
 
 
     @app_commands.command(name="skip", description="Skip the current song")
     async def skip(self, interaction: discord.Interaction):
-        if not self.voice_client:
-            raise BotNotInVoiceException()
-        if not interaction.user.voice.channel == self.voice_client.channel:
-            raise DifferentVoiceChannelException()
+        player = self.get_connected_player(interaction)
 
-        if self.is_playing():
-            self.voice_client.stop()
+        if player.skip():
             await interaction.response.send_message(f"Song geskippt")
-            self._play()
         else:
             await interaction.response.send_message("Ich spiele nichts")
 
     @app_commands.command(name="stop", description="Stop the current song")
     async def stop(self, interaction: discord.Interaction):
-        if not self.voice_client:
-            raise BotNotInVoiceException()
-        if not interaction.user.voice.channel == self.voice_client.channel:
-            raise DifferentVoiceChannelException()
+        player = self.get_connected_player(interaction)
 
-        if self.is_playing():
+        if player.is_playing():
             await interaction.response.send_message(f"Halt Stopp")
-            self.current_song = None
-            self.queue.clear()
-            self.voice_client.stop()
+            player.stop()
         else:
             await interaction.response.send_message("Ich spiele nichts")
 
     @app_commands.command(name="queue", description="Show the current queue")
     @app_commands.describe(page="Page number of the queue")
     async def queue(self, interaction: discord.Interaction, page: int = 1):
-        if not self.voice_client:
-            raise BotNotInVoiceException()
-        if not interaction.user.voice.channel == self.voice_client.channel:
-            raise DifferentVoiceChannelException()
-        page = 1 if page < 1 else page
-        start = (page - 1) * 15
-        end = start + 15
-        queue = ''
-        for i, song in enumerate(self.queue[start:end], start=start):
-            queue += '`{0}.` [**{1.name}**]({1.url})\n'.format(i + 1, song)
-        embed = Embed(colour=0x00FF00,
-                      description=f'**{len(self.get_queue())} tracks**\nDuration: {timedelta(seconds=self.duration())}\n\n{queue}')
-        embed.set_footer(text=f'Viewing page {page} of {len(self.queue) // 15 + 1}')
-        await interaction.response.send_message(embed=embed)
+        player = self.get_connected_player(interaction)
+        view = QueueView(player.pages, page)
+        await interaction.response.send_message(embed=view.current(), view=view)
+        view.message = await interaction.original_response()
 
     @app_commands.command(name="disconnect", description="Verlasse den Voice Channel")
     async def disconnect(self, interaction: discord.Interaction):
-        if not self.voice_client:
-            raise BotNotInVoiceException()
-        if not interaction.user.voice.channel == self.voice_client.channel:
-            raise DifferentVoiceChannelException()
+        player = self.get_connected_player(interaction)
 
-        await self._disconnect()
+        await player._disconnect()
+        self.evict_player(interaction.guild_id)
 
     @app_commands.command(name="clear", description="Zeige die Warteschlange")
     async def clear(self, interaction: discord.Interaction):
-        if not self.voice_client:
-            raise BotNotInVoiceException()
-        if not interaction.user.voice.channel == self.voice_client.channel:
-            raise DifferentVoiceChannelException()
+        player = self.get_connected_player(interaction)
 
-        self.clear_queue()
+        player.clear_queue()
         await interaction.response.send_message("Warteschlange gelöscht")
 
     @app_commands.command(name="now", description="Zeige den aktuellen Song")
     async def now(self, interaction: discord.Interaction):
-        if not self.voice_client:
-            raise BotNotInVoiceException()
-        if not interaction.user.voice.channel == self.voice_client.channel:
-            raise DifferentVoiceChannelException()
+        player = self.get_connected_player(interaction)
+
+        if player.is_playing():
+            await interaction.response.send_message(f"Es wird gespielt: {player.current_song.name}:{player.current_song.duration}\n{player.current_song.url}")
+        else:
+            await interaction.response.send_message("Ich spiele nichts")
 
-        if self.is_playing():
-            await interaction.response.send_message(f"Es wird gespielt: {self.current_song.name}:{self.current_song.duration}\n{self.current_song.url}")
+    @app_commands.command(name="seek", description="Springe an eine Stelle im aktuellen Song")
+    @app_commands.describe(position="Zeit wie 1:30 oder 90, mit + oder - relativ zur aktuellen Stelle")
+    async def seek(self, interaction: discord.Interaction, position: str):
+        player = self.get_connected_player(interaction)
+
+        parsed = parse_timestamp(position)
+        if parsed is None:
+            await interaction.response.send_message("Das ist keine gültige Zeit")
+            return
+        if not player.is_playing():
+            await interaction.response.send_message("Ich spiele nichts")
+            return
+        offset, relative = parsed
+        if relative:
+            offset += player.elapsed()
+        duration = player.current_song.duration or 0
+        # Both refuse while the song is still resolving, is_playing() already counts that as playing
+        if duration and offset >= duration:
+            if player.skip():
+                await interaction.response.send_message("Song geskippt")
+            else:
+                await interaction.response.send_message("Ich spiele nichts")
+        elif player.seek(offset):
+            await interaction.response.send_message(f"Springe zu {timedelta(seconds=floor(max(0.0, offset)))}")
         else:
             await interaction.response.send_message("Ich spiele nichts")
 
+    @app_commands.command(name="resume", description="Setze den zuletzt gestoppten Song fort")
+    async def resume(self, interaction: discord.Interaction):
+        player = self.get_connected_player(interaction)
+
+        if player.is_playing():
+            await interaction.response.send_message("Ich spiele schon")
+        elif not player.resume_point:
+            await interaction.response.send_message("Es gibt nichts zum Fortsetzen")
+        else:
+            song, offset = player.resume_point
+            player.resume_point = None
+            player.resume(song, offset)
+            await interaction.response.send_message(f"{song.name} wird bei {timedelta(seconds=floor(offset))} fortgesetzt")
+
     @app_commands.command(name="shuffle", description="Mische die Warteschlange")
     async def shuffle(self, interaction: discord.Interaction):
-        if not self.voice_client:
-            raise BotNotInVoiceException()
-        if not interaction.user.voice.channel == self.voice_client.channel:
-            raise DifferentVoiceChannelException()
+        player = self.get_connected_player(interaction)
 
-        random.shuffle(self.queue)
+        player.shuffle_queue()
         await interaction.response.send_message("Warteschlange gemischt")
 
     @app_commands.command(name="leave", description="Lasse den Bot den Channel verlassen wenn niemand mehr da ist")
     async def leave(self, interaction: discord.Interaction):
-        if not self.voice_client:
-            raise BotNotInVoiceException()
-        if not interaction.user.voice.channel == self.voice_client.channel:
-            raise DifferentVoiceChannelException()
+        player = self.get_connected_player(interaction)
 
-        await self._disconnect()
-        await self.queue.clear()
-        self.current_song = None
+        await player._disconnect()
+        self.evict_player(interaction.guild_id)
         await interaction.response.send_message("Ich habe den Channel verlassen")
 
     @app_commands.command(name="playnext", description="Spiele den Song als nächstes")
     @app_commands.describe(song="Name or URL of the song")
     async def playnext(self, interaction: discord.Interaction, *, song: str):
+        requested_at = time.perf_counter()
         await interaction.response.defer()
         if not interaction.user.voice:
             raise UserNotInVoiceException()
-        if not self.voice_client:
-            await self.connect_to_channel(interaction.user.voice.channel)
-        if not interaction.user.voice.channel == self.voice_client.channel:
+        player = self.get_player(interaction.guild_id)
+        if not player.voice_client:
+            await player.connect_to_channel(interaction.user.voice.channel)
+        if not interaction.user.voice.channel == player.voice_client.channel:
             raise DifferentVoiceChannelException()
 
         if validators.url(song):
-            song: Song = self.getter.fetch_from_url(song)
+            song: SongRecord = await self.getter.fetch_from_url(song)
         else:
-            song: Song = self.getter.get_song_by_name(song)
+            song: SongRecord = await self.getter.get_song_by_name(song)
 
-        self.queue.insert(0, song)
+        player.add_next(song, interaction.user.id)
         song_name = song.name
-        if not self.is_playing():
-            self._play()
         await interaction.followup.send(f"{song_name} wird als nächstes gespielt")
+        if not player.is_playing():
+            player.start(requested_at)
+        else:
+            self.bot.loop.create_task(player.prefetch_stream_urls())
+
+    @play.autocomplete("song")
+    @playnext.autocomplete("song")
+    async def song_autocomplete(self, interaction: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
+        # Answered from memory only, Discord drops autocomplete responses after 3 seconds
+        return [app_commands.Choice(name=name, value=value) for name, value in self.getter.names.search(current, self.getter.radio.play_counts)]
+
+    @app_commands.command(name="playlist", description="Spiele eine Playlist")
+    @app_commands.describe(playlist="URL oder Name der Playlist")
+    async def playlist(self, interaction: discord.Interaction, *, playlist: str):
+        requested_at = time.perf_counter()
+        await interaction.response.defer()
+        if not interaction.user.voice:
+            raise UserNotInVoiceException()
+        player = self.get_player(interaction.guild_id)
+        if not player.voice_client:
+            await player.connect_to_channel(interaction.user.voice.channel)
+        if not interaction.user.voice.channel == player.voice_client.channel:
+            raise DifferentVoiceChannelException()
+
+        async def enqueue(song: SongRecord):
+            player.add_to_queue(song, interaction.user.id)
+            player.start(requested_at)
+
+        if validators.url(playlist):
+            name, entries = await self.getter.expand_playlist(playlist)
+            await interaction.followup.send(f"Lade {len(entries)} Songs aus {name}")
+            songs = await self.getter.import_playlist(name, entries, enqueue)
+        else:
+            stored = await self.getter.db.get_playlist_by_name(playlist)
+            if stored is None:
+                await interaction.followup.send("Playlist nicht gefunden")
+                return
+            name = stored.name
+            songs = await self.getter.db.get_playlist_songs(stored.id)
+            for song in songs:
+                await enqueue(song)
+        await interaction.followup.send(f"{len(songs)} Songs aus {name} zur Warteschlange hinzugefügt")
+
+    @app_commands.command(name="autoplay", description="Spiele ähnliche Songs weiter wenn die Warteschlange leer ist")
+    async def autoplay(self, interaction: discord.Interaction):
+        player = self.get_connected_player(interaction)
+
+        player.autoplay = not player.autoplay
+        if player.autoplay:
+            if player.current_song and player.current_song.id not in player.history:
+                player.history.append(player.current_song.id)
+            await interaction.response.send_message("Autoplay ist an")
+            if player.history:
+                player.start()
+        else:
+            await interaction.response.send_message("Autoplay ist aus")
+
+    @app_commands.command(name="fair", description="Wechsle zwischen fairer Reihenfolge pro Nutzer und normaler Warteschlange")
+    async def fair(self, interaction: discord.Interaction):
+        player = self.get_connected_player(interaction)
+
+        player.queue.set_fair(not player.queue.fair)
+        player.queue_changed()
+        if player.queue.fair:
+            await interaction.response.send_message("Die Warteschlange wechselt jetzt zwischen den Nutzern ab")
+        else:
+            await interaction.response.send_message("Die Warteschlange spielt wieder der Reihe nach")
+
+    @app_commands.command(name="stats", description="Zeige Latenzen und Auslastung des Bots")
+    async def stats(self, interaction: discord.Interaction):
+        if not await self.bot.is_owner(interaction.user):
+            await interaction.response.send_message("Das darf nur der Besitzer", ephemeral=True)
+            return
+        lines = Metrics.summary() or ["Noch keine Messwerte"]
+        await interaction.response.send_message(f"```\n{chr(10).join(lines)[:1900]}\n```", ephemeral=True)
@@ -0,0 +1,194 @@
+import bisect
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from aiohttp import web
+
+
+metrics_options = {
+    'enabled': True,
+    # Only reachable from the host, put a reverse proxy in front to scrape from elsewhere
+    'host': '127.0.0.1',
+    'port': 9464,
+}
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+db_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def label_key(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Iterable[float] = default_buckets):
+        self.name: str = name
+        self.help: str = help
+        self.buckets: List[float] = sorted(buckets)
+        # labels -> (count per bucket plus +Inf, sum)
+        self.series: Dict[Labels, Tuple[List[int], List[float]]] = {}
+        # Observed from extractor threads and SQLAlchemy's greenlet as well as the event loop
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = label_key(labels)
+        with self.lock:
+            counts, total = self.series.get(key) or self.series.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    def count(self, **labels) -> int:
+        series = self.series.get(label_key(labels))
+        return sum(series[0]) if series else 0
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        # Interpolated inside the bucket like Prometheus' histogram_quantile
+        series = self.series.get(label_key(labels))
+        if not series or not sum(series[0]):
+            return None
+        counts = series[0]
+        rank = q * sum(counts)
+        seen = 0
+        for i, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(key, list(counts), total[0]) for key, (counts, total) in self.series.items()]
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + [float("inf")], counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{format_labels(key, ('le', le))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(key)} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name: str = name
+        self.help: str = help
+        self.values: Dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(label_key(labels), 0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{format_labels(key)} {value}" for key, value in list(self.values.items())]
+        return lines
+
+
+class Gauge:
+    # Read at scrape time from a callback returning labels -> value, nothing to keep in sync
+    def __init__(self, name: str, help: str, collect: Optional[Callable[[], Dict[Labels, float]]] = None):
+        self.name: str = name
+        self.help: str = help
+        self.collect: Callable[[], Dict[Labels, float]] = collect or dict
+
+    def values(self) -> Dict[Labels, float]:
+        try:
+            return self.collect()
+        except Exception as e:
+            print(f"Could not collect {self.name}: {e}")
+            return {}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        lines += [f"{self.name}{format_labels(key)} {value}" for key, value in self.values().items()]
+        return lines
+
+
+first_audio_seconds = Histogram("musi_first_audio_seconds", "Time from a play command to the start of audio")
+extraction_seconds = Histogram("musi_extraction_seconds", "yt-dlp extraction time by platform")
+db_query_seconds = Histogram("musi_db_query_seconds", "SQLite statement execution time", db_buckets)
+stream_url_refreshes = Counter("musi_stream_url_refreshes_total", "Stream urls resolved again through yt-dlp")
+transition_gap_seconds = Histogram("musi_transition_gap_seconds", "Silence between two songs")
+ffmpeg_processes = Gauge("musi_ffmpeg_processes", "FFmpeg processes currently running")
+queue_depth = Gauge("musi_queue_depth", "Songs waiting in each guild's queue")
+ffmpeg_cpu_seconds = Gauge("musi_ffmpeg_cpu_seconds", "CPU time used by each running FFmpeg process")
+ffmpeg_rss_bytes = Gauge("musi_ffmpeg_rss_bytes", "Resident memory of each running FFmpeg process")
+ffmpeg_kills = Counter("musi_ffmpeg_kills_total", "FFmpeg processes killed by the supervisor")
+ffmpeg_restarts = Counter("musi_ffmpeg_restarts_total", "Stalled streams restarted at their last position")
+
+registry = [first_audio_seconds, extraction_seconds, db_query_seconds, stream_url_refreshes, transition_gap_seconds,
+            ffmpeg_processes, queue_depth, ffmpeg_cpu_seconds, ffmpeg_rss_bytes, ffmpeg_kills, ffmpeg_restarts]
+
+
+def render() -> str:
+    return "\n".join(line for metric in registry for line in metric.render()) + "\n"
+
+
+def summary() -> List[str]:
+    # Compact text for /stats, quantiles in milliseconds
+    lines = []
+    for metric in registry:
+        if isinstance(metric, Histogram):
+            for key in list(metric.series):
+                labels = dict(key)
+                p50, p99 = metric.quantile(0.5, **labels), metric.quantile(0.99, **labels)
+                lines.append(f"{metric.name}{format_labels(key)}: n={metric.count(**labels)} "
+                             f"p50={p50 * 1000:.1f}ms p99={p99 * 1000:.1f}ms")
+        elif isinstance(metric, Counter):
+            lines += [f"{metric.name}{format_labels(key)}: {value:g}" for key, value in list(metric.values.items())]
+        elif isinstance(metric, Gauge):
+            values = metric.values()
+            if len(values) > 5:
+                lines.append(f"{metric.name}: {len(values)} series, max {max(values.values()):g}, sum {sum(values.values()):g}")
+            else:
+                lines += [f"{metric.name}{format_labels(key)}: {value:g}" for key, value in values.items()]
+    return lines
+
+
+class MetricsServer:
+    def __init__(self, enabled: bool = True, host: str = '127.0.0.1', port: int = 9464):
+        self.enabled: bool = enabled
+        self.host: str = host
+        self.port: int = port
+        self.runner: Optional[web.AppRunner] = None
+
+    async def handle(self, _request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self):
+        if not self.enabled or self.runner:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        try:
+            await web.TCPSite(self.runner, self.host, self.port).start()
+        except OSError as e:
+            # A second instance or a stale process still holds the port, the bot runs fine without it
+            print(f"Could not start metrics endpoint on {self.host}:{self.port}: {e}")
+            await self.stop()
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
@@ -0,0 +1,82 @@
+import heapq
+import re
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+name_index_options = {
+    # Discord shows at most 25 choices
+    'limit': 25,
+}
+
+# Discord caps choice names and values at 100 characters
+choice_max_length = 100
+
+name_word_re = re.compile(r"\w+")
+
+
+def normalize_name(text: str) -> str:
+    return " ".join(name_word_re.findall(unicodedata.normalize("NFKC", text).casefold()))
+
+
+def trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class NameIndex:
+    def __init__(self, limit: int = 25):
+        self.limit: int = limit
+        # song id -> normalized "name artist"
+        self.texts: Dict[int, str] = {}
+        self.choices: Dict[int, Tuple[str, str]] = {}
+        self.trigrams: Dict[str, Set[int]] = {}
+        # First one and two letters of every word, queries too short for trigrams use these
+        self.prefixes: Dict[str, Set[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def load(self, songs: Iterable[Tuple[int, str, Optional[str], Optional[str]]]):
+        for song_id, name, artist, url in songs:
+            self.add(song_id, name, artist, url)
+
+    def add(self, song_id: int, name: str, artist: Optional[str], url: Optional[str]):
+        if song_id in self.texts or not name:
+            return
+        text = normalize_name(f"{name} {artist or ''}")
+        self.texts[song_id] = text
+        label = f"{name} - {artist}" if artist else name
+        # The url is sent back as the command argument and resolves straight from the database
+        value = url if url and len(url) <= choice_max_length else name
+        self.choices[song_id] = (label[:choice_max_length], value[:choice_max_length])
+        for gram in trigrams(text):
+            self.trigrams.setdefault(gram, set()).add(song_id)
+        for word in text.split():
+            self.prefixes.setdefault(word[:1], set()).add(song_id)
+            self.prefixes.setdefault(word[:2], set()).add(song_id)
+
+    def candidates(self, query: str) -> Set[int]:
+        if len(query) < 3:
+            return self.prefixes.get(query, set())
+        sets = sorted((self.trigrams.get(gram, set()) for gram in trigrams(query)), key=len)
+        if not sets or not sets[0]:
+            return set()
+        found = set(sets[0])
+        for other in sets[1:]:
+            found &= other
+            if not found:
+                break
+        return found
+
+    def search(self, query: str, weights: Optional[Dict[int, int]] = None) -> List[Tuple[str, str]]:
+        query = normalize_name(query)
+        if not query:
+            return []
+        weights = weights or {}
+        texts = self.texts
+        # Names starting with the query first, then substring hits, most played first
+        found = heapq.nlargest(self.limit, (
+            (texts[song_id].startswith(query), query in texts[song_id], weights.get(song_id, 0), -len(texts[song_id]), song_id)
+            for song_id in self.candidates(query)
+        ))
+        return [self.choices[key[-1]] for key in found]
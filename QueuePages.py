@@ -0,0 +1,113 @@
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+import discord
+from discord import Embed
+
+from SongQueue import QueueEntry, SongQueue
+
+
+queue_pages_options = {
+    'page_size': 15,
+    # Long titles are cut so a full page stays far below Discord's 4096 character limit
+    'max_name_length': 80,
+    # Seconds the buttons keep working after the last click
+    'timeout': 180,
+}
+
+
+class QueuePages:
+    def __init__(self, queue: SongQueue, page_size: int = 15, max_name_length: int = 80, timeout: float = 180):
+        self.queue: SongQueue = queue
+        self.page_size: int = page_size
+        self.max_name_length: int = max_name_length
+        self.timeout: float = timeout
+        # Queue version the cache below belongs to
+        self.version: int = -1
+        # Order of the queue at that version, taken once and sliced for every page
+        self.entries: Optional[List[QueueEntry]] = None
+        self.rendered: Dict[int, Embed] = {}
+
+    def sync(self):
+        if self.version != self.queue.version:
+            self.version = self.queue.version
+            self.entries = None
+            self.rendered.clear()
+
+    def count(self) -> int:
+        return max(1, -(-len(self.queue) // self.page_size))
+
+    def clamp(self, page: int) -> int:
+        return min(max(page, 1), self.count())
+
+    def line(self, position: int, entry: QueueEntry) -> str:
+        name = entry.song.name
+        if len(name) > self.max_name_length:
+            name = name[:self.max_name_length - 1] + "…"
+        return '`{0}.` [**{1}**]({2})'.format(position, name, entry.song.url)
+
+    def embed(self, page: int) -> Embed:
+        # Only pages that are actually looked at get rendered, each at most once per queue version
+        self.sync()
+        page = self.clamp(page)
+        embed = self.rendered.get(page)
+        if embed is None:
+            if self.entries is None:
+                self.entries = list(self.queue.iter_entries())
+            start = (page - 1) * self.page_size
+            lines = "\n".join(self.line(i + 1, entry)
+                              for i, entry in enumerate(self.entries[start:start + self.page_size], start=start))
+            embed = Embed(colour=0x00FF00,
+                          description=f'**{len(self.entries)} tracks**\nDuration: {timedelta(seconds=self.queue.duration)}\n\n{lines}')
+            embed.set_footer(text=f'Viewing page {page} of {self.count()}')
+            self.rendered[page] = embed
+        return embed
+
+
+class QueueView(discord.ui.View):
+    def __init__(self, pages: QueuePages, page: int = 1):
+        super().__init__(timeout=pages.timeout)
+        self.pages: QueuePages = pages
+        self.page: int = pages.clamp(page)
+        self.message: Optional[discord.Message] = None
+        self.update_buttons()
+
+    def update_buttons(self):
+        last = self.pages.count()
+        self.first_page.disabled = self.previous_page.disabled = self.page <= 1
+        self.next_page.disabled = self.last_page.disabled = self.page >= last
+
+    def current(self) -> Embed:
+        self.page = self.pages.clamp(self.page)
+        self.update_buttons()
+        return self.pages.embed(self.page)
+
+    async def show(self, interaction: discord.Interaction, page: int):
+        self.page = page
+        await interaction.response.edit_message(embed=self.current(), view=self)
+
+    @discord.ui.button(label="⏮", style=discord.ButtonStyle.secondary)
+    async def first_page(self, interaction: discord.Interaction, _button: discord.ui.Button):
+        await self.show(interaction, 1)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, _button: discord.ui.Button):
+        await self.show(interaction, self.page - 1)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, _button: discord.ui.Button):
+        await self.show(interaction, self.page + 1)
+
+    @discord.ui.button(label="⏭", style=discord.ButtonStyle.secondary)
+    async def last_page(self, interaction: discord.Interaction, _button: discord.ui.Button):
+        await self.show(interaction, self.pages.count())
+
+    async def on_timeout(self):
+        if self.message is None:
+            return
+        for item in self.children:
+            item.disabled = True
+        try:
+            await self.message.edit(view=self)
+        except discord.HTTPException:
+            pass
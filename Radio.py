@@ -0,0 +1,106 @@
+import heapq
+import math
+import random
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+radio_options = {
+    # Precomputed candidates kept per song
+    'neighbours': 25,
+    'playlist_weight': 3.0,
+    'artist_weight': 1.0,
+    # Huge playlists say little about two songs belonging together and cost quadratic time
+    'max_playlist_size': 300,
+    # Picks are drawn from this many of the best unplayed candidates
+    'spread': 5,
+}
+
+
+class RadioIndex:
+    def __init__(self, neighbours: int = 25, playlist_weight: float = 3.0, artist_weight: float = 1.0,
+                 max_playlist_size: int = 300, spread: int = 5):
+        self.neighbour_count: int = neighbours
+        self.playlist_weight: float = playlist_weight
+        self.artist_weight: float = artist_weight
+        self.max_playlist_size: int = max_playlist_size
+        self.spread: int = spread
+        self.cooccurrence: Dict[int, Counter] = defaultdict(Counter)
+        self.playlists: Dict[int, List[int]] = defaultdict(list)
+        self.artist_of: Dict[int, str] = {}
+        self.by_artist: Dict[str, List[int]] = defaultdict(list)
+        self.play_counts: Dict[int, int] = {}
+        # Ranked candidates per song, replaced as a whole so readers never see a half built list
+        self.neighbours: Dict[int, Tuple[int, ...]] = {}
+        self.popular: Tuple[int, ...] = ()
+        # Highest Songs.id and PlaylistSongs.id seen, the next refresh only reads rows past them
+        self.last_song: int = 0
+        self.last_entry: int = 0
+
+    def __len__(self) -> int:
+        return len(self.neighbours)
+
+    def add_songs(self, songs: Iterable[Tuple[int, Optional[str]]]) -> Set[int]:
+        dirty = set()
+        for song_id, artist in songs:
+            self.last_song = max(self.last_song, song_id)
+            dirty.add(song_id)
+            if artist:
+                self.artist_of[song_id] = artist
+                self.by_artist[artist].append(song_id)
+        return dirty
+
+    def add_playlist_entries(self, entries: Iterable[Tuple[int, int, int]]) -> Set[int]:
+        dirty = set()
+        for entry_id, playlist_id, song_id in entries:
+            self.last_entry = max(self.last_entry, entry_id)
+            members = self.playlists[playlist_id]
+            if len(members) < self.max_playlist_size:
+                for other in members:
+                    if other != song_id:
+                        self.cooccurrence[song_id][other] += 1
+                        self.cooccurrence[other][song_id] += 1
+                        dirty.add(other)
+            members.append(song_id)
+            dirty.add(song_id)
+        return dirty
+
+    def set_play_counts(self, counts: Dict[int, int]):
+        self.play_counts = counts
+        self.popular = tuple(heapq.nlargest(self.neighbour_count * 4, counts, key=counts.get))
+
+    def score(self, song_id: int, other: int) -> float:
+        score = self.playlist_weight * self.cooccurrence[song_id].get(other, 0)
+        artist = self.artist_of.get(song_id)
+        if artist and artist == self.artist_of.get(other):
+            score += self.artist_weight
+        # Popularity only breaks ties between equally related songs
+        return score + math.log1p(self.play_counts.get(other, 0)) * 0.1
+
+    def rebuild(self, song_ids: Optional[Iterable[int]] = None):
+        if song_ids is None:
+            song_ids = self.artist_of.keys() | self.cooccurrence.keys()
+        for song_id in song_ids:
+            candidates = set(self.cooccurrence[song_id])
+            artist = self.artist_of.get(song_id)
+            if artist:
+                candidates.update(heapq.nlargest(self.neighbour_count, self.by_artist[artist],
+                                                 key=lambda s: self.play_counts.get(s, 0)))
+            candidates.discard(song_id)
+            self.neighbours[song_id] = tuple(heapq.nlargest(self.neighbour_count, candidates,
+                                                            key=lambda other: self.score(song_id, other)))
+
+    def update(self, songs: Iterable[Tuple[int, Optional[str]]], entries: Iterable[Tuple[int, int, int]],
+               counts: Dict[int, int], full: bool = False):
+        dirty = self.add_songs(songs) | self.add_playlist_entries(entries)
+        self.set_play_counts(counts)
+        self.rebuild(None if full else dirty)
+
+    def pick(self, seeds: Iterable[int], exclude: Set[int]) -> Optional[int]:
+        # Walks at most spread candidates of the latest seeds, no database access
+        for seed in seeds:
+            candidates = [s for s in self.neighbours.get(seed, ()) if s not in exclude][:self.spread]
+            if candidates:
+                return random.choice(candidates)
+        candidates = [s for s in self.popular if s not in exclude][:self.spread]
+        return random.choice(candidates) if candidates else None
@@ -0,0 +1,203 @@
+import itertools
+import random
+from collections import deque
+from typing import Deque, Dict, Iterator, List, Optional
+
+from Database import SongRecord
+
+
+class QueueEntry:
+    __slots__ = ("id", "song", "user_id", "removed")
+
+    def __init__(self, id: int, song: SongRecord, user_id: Optional[int]):
+        self.id: int = id
+        self.song: SongRecord = song
+        self.user_id: Optional[int] = user_id
+        self.removed: bool = False
+
+
+class SongQueue:
+    def __init__(self, fair: bool = False):
+        # playnext entries always come first, newest first
+        self.front: Deque[QueueEntry] = deque()
+        # One bucket per user in fair mode, a single bucket under None otherwise
+        self.buckets: Dict[Optional[int], Deque[QueueEntry]] = {}
+        # Round robin order of the buckets, the next song comes from the leftmost one
+        self.rotation: Deque[Optional[int]] = deque()
+        self.entries: Dict[int, QueueEntry] = {}
+        self.ids = itertools.count()
+        self.fair: bool = fair
+        self.duration: float = 0
+        # Removed entries stay in their deque until they are popped or compacted away
+        self.tombstones: int = 0
+        # Bumped on every change of content or order, cached renders of the queue compare against it
+        self.version: int = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __bool__(self) -> bool:
+        return bool(self.entries)
+
+    def __iter__(self) -> Iterator[SongRecord]:
+        return (entry.song for entry in self.iter_entries())
+
+    def __contains__(self, song: SongRecord) -> bool:
+        return any(entry.song.id == song.id for entry in self.entries.values())
+
+    def _new_entry(self, song: SongRecord, user_id: Optional[int]) -> QueueEntry:
+        entry = QueueEntry(next(self.ids), song, user_id)
+        self.entries[entry.id] = entry
+        self.duration += song.duration or 0
+        self.version += 1
+        return entry
+
+    def _bucket(self, user_id: Optional[int]) -> Deque[QueueEntry]:
+        key = user_id if self.fair else None
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = deque()
+            self.rotation.append(key)
+        return bucket
+
+    def append(self, song: SongRecord, user_id: Optional[int] = None) -> QueueEntry:
+        entry = self._new_entry(song, user_id)
+        self._bucket(user_id).append(entry)
+        return entry
+
+    def appendleft(self, song: SongRecord, user_id: Optional[int] = None) -> QueueEntry:
+        entry = self._new_entry(song, user_id)
+        self.front.appendleft(entry)
+        return entry
+
+    def _pop_live(self, dq: Deque[QueueEntry]) -> Optional[QueueEntry]:
+        while dq:
+            entry = dq.popleft()
+            if not entry.removed:
+                return entry
+            self.tombstones -= 1
+        return None
+
+    def _peek_live(self, dq: Deque[QueueEntry]) -> Optional[QueueEntry]:
+        while dq and dq[0].removed:
+            dq.popleft()
+            self.tombstones -= 1
+        return dq[0] if dq else None
+
+    def _forget(self, entry: QueueEntry):
+        del self.entries[entry.id]
+        self.duration -= entry.song.duration or 0
+        self.version += 1
+        if not self.entries:
+            self.duration = 0
+
+    def popleft_entry(self) -> Optional[QueueEntry]:
+        entry = self._pop_live(self.front)
+        while entry is None and self.rotation:
+            key = self.rotation[0]
+            entry = self._pop_live(self.buckets[key])
+            if self.buckets[key]:
+                self.rotation.rotate(-1)
+            else:
+                self.rotation.popleft()
+                del self.buckets[key]
+        if entry is not None:
+            self._forget(entry)
+        return entry
+
+    def popleft(self) -> Optional[SongRecord]:
+        entry = self.popleft_entry()
+        return entry.song if entry else None
+
+    def peek_entry(self) -> Optional[QueueEntry]:
+        entry = self._peek_live(self.front)
+        if entry is not None:
+            return entry
+        for key in self.rotation:
+            entry = self._peek_live(self.buckets[key])
+            if entry is not None:
+                return entry
+        return None
+
+    def peek(self) -> Optional[SongRecord]:
+        entry = self.peek_entry()
+        return entry.song if entry else None
+
+    def remove(self, entry_id: int) -> bool:
+        entry = self.entries.get(entry_id)
+        if entry is None:
+            return False
+        entry.removed = True
+        self.tombstones += 1
+        self._forget(entry)
+        if self.tombstones > 64 and self.tombstones > len(self.entries):
+            self.compact()
+        return True
+
+    def remove_song(self, song: SongRecord) -> bool:
+        for entry in self.iter_entries():
+            if entry.song.id == song.id:
+                return self.remove(entry.id)
+        return False
+
+    def move_to_front(self, entry_id: int) -> bool:
+        entry = self.entries.get(entry_id)
+        if entry is None:
+            return False
+        self.remove(entry_id)
+        self.appendleft(entry.song, entry.user_id)
+        return True
+
+    def compact(self):
+        self.front = deque(e for e in self.front if not e.removed)
+        for key in list(self.rotation):
+            self.buckets[key] = deque(e for e in self.buckets[key] if not e.removed)
+        self.tombstones = 0
+
+    def clear(self):
+        self.front.clear()
+        self.buckets.clear()
+        self.rotation.clear()
+        self.entries.clear()
+        self.duration = 0
+        self.tombstones = 0
+        self.version += 1
+
+    def iter_entries(self) -> Iterator[QueueEntry]:
+        live = (e for e in self.front if not e.removed)
+        if len(self.rotation) <= 1:
+            rest = (e for key in self.rotation for e in self.buckets[key] if not e.removed)
+            return itertools.chain(live, rest)
+        # Interleave the buckets the same way popleft will serve them. Removed entries are dropped per bucket
+        # first, popleft skips them inside a bucket's turn instead of giving the turn away.
+        iterators = [(e for e in self.buckets[key] if not e.removed) for key in self.rotation]
+        rounds = itertools.chain.from_iterable(itertools.zip_longest(*iterators))
+        return itertools.chain(live, (e for e in rounds if e is not None))
+
+    def page(self, start: int, end: int) -> List[QueueEntry]:
+        if self.tombstones:
+            self.compact()
+        return list(itertools.islice(self.iter_entries(), start, end))
+
+    def head(self, count: int) -> List[SongRecord]:
+        return [entry.song for entry in itertools.islice(self.iter_entries(), count)]
+
+    def shuffle(self):
+        self.compact()
+        for key in self.rotation:
+            entries = list(self.buckets[key])
+            random.shuffle(entries)
+            self.buckets[key] = deque(entries)
+        self.version += 1
+
+    def set_fair(self, fair: bool):
+        if fair == self.fair:
+            return
+        entries = [e for key in self.rotation for e in self.buckets[key] if not e.removed]
+        self.fair = fair
+        self.buckets.clear()
+        self.rotation.clear()
+        self.tombstones = sum(1 for e in self.front if e.removed)
+        for entry in entries:
+            self._bucket(entry.user_id).append(entry)
+        self.version += 1
@@ -0,0 +1,102 @@
+import subprocess
+import time
+from collections import deque
+from typing import Deque, Optional
+from urllib.parse import parse_qs, urlparse
+
+import discord
+
+
+# googlevideo audio-only itags that carry Opus in WebM
+opus_itags = {'249', '250', '251'}
+
+
+def guess_codec(url: str) -> Optional[str]:
+    query = parse_qs(urlparse(url).query)
+    itag = query.get('itag', [None])[0]
+    if itag in opus_itags:
+        return 'opus'
+    mime = query.get('mime', [''])[0]
+    if 'opus' in mime:
+        return 'opus'
+    return None
+
+
+def with_offset(options: dict, offset: float) -> dict:
+    # -ss before -i makes FFmpeg seek in the input instead of decoding up to the offset
+    if offset <= 0:
+        return options
+    return {**options, 'before_options': f"-ss {offset:.3f} " + options.get('before_options', '')}
+
+
+async def create_source(stream: str, options: dict, mode: str = 'opus', bitrate: int = 128) -> discord.AudioSource:
+    # pcm:   FFmpeg decodes to PCM and discord.py encodes Opus in Python (old behaviour)
+    # opus:  Opus streams are copied through untouched, everything else is transcoded to Opus by FFmpeg
+    # probe: like opus, but unknown streams are probed with ffprobe before choosing copy or transcode
+    if mode == 'pcm':
+        return discord.FFmpegPCMAudio(stream, **options)
+    if guess_codec(stream) == 'opus':
+        return discord.FFmpegOpusAudio(stream, codec='copy', bitrate=bitrate, **options)
+    if mode == 'probe':
+        return await discord.FFmpegOpusAudio.from_probe(stream, method='fallback', bitrate=bitrate, **options)
+    return discord.FFmpegOpusAudio(stream, bitrate=bitrate, **options)
+
+
+class PrefetchedSource(discord.AudioSource):
+    def __init__(self, source: discord.AudioSource, frames: int = 150):
+        self.source: discord.AudioSource = source
+        self.frames: int = frames
+        self.buffer: Deque[bytes] = deque()
+
+    def fill(self):
+        # Blocking, meant to run in an executor while the previous song is still playing.
+        # Pulls the first frames through FFmpeg so process start and HTTP connect are already paid for.
+        while len(self.buffer) < self.frames:
+            data = self.source.read()
+            if not data:
+                break
+            self.buffer.append(data)
+
+    def read(self) -> bytes:
+        if self.buffer:
+            return self.buffer.popleft()
+        return self.source.read()
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.buffer.clear()
+        self.source.cleanup()
+
+
+class WatchedSource(discord.AudioSource):
+    # Outermost wrapper of a playing source, counts frames so the position survives a restart of FFmpeg
+    def __init__(self, source: discord.AudioSource, offset: float = 0):
+        self.source: discord.AudioSource = source
+        self.offset: float = offset
+        self.frames: int = 0
+        self.last_read: float = time.monotonic()
+
+    def read(self) -> bytes:
+        data = self.source.read()
+        if data:
+            self.frames += 1
+            self.last_read = time.monotonic()
+        return data
+
+    def position(self) -> float:
+        return self.offset + self.frames * 0.02
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+
+
+def ffmpeg_process(source: Optional[discord.AudioSource]) -> Optional[subprocess.Popen]:
+    while isinstance(source, (WatchedSource, PrefetchedSource)):
+        source = source.source
+    process = getattr(source, '_process', None)
+    return process if process is not None and process.poll() is None else None
@@ -0,0 +1,89 @@
+import re
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+
+stream_cache_options = {
+    # Refresh a url this many seconds before googlevideo would expire it
+    'margin': 120,
+    # Lifetime assumed for stream urls that carry no expire= parameter (e.g. Soundcloud)
+    'default_ttl': 1800,
+    # Number of queued songs per player whose urls are kept warm in the background
+    'prefetch': 3,
+    # Urls kept at most, the least recently resolved go first. Expired ones are pruned periodically anyway.
+    'max_entries': 2000,
+}
+
+expire_path_re = re.compile(r"/expire/(\d+)")
+
+
+def parse_expiry(url: Optional[str]) -> Optional[float]:
+    if not url:
+        return None
+    parsed = urlparse(url)
+    expire = parse_qs(parsed.query).get('expire', [None])[0]
+    if expire is None:
+        match = expire_path_re.search(parsed.path)
+        expire = match.group(1) if match else None
+    try:
+        return float(expire) if expire is not None else None
+    except ValueError:
+        return None
+
+
+class StreamCache:
+    def __init__(self, margin: float = 120, default_ttl: float = 1800, prefetch: int = 3, max_entries: int = 2000):
+        self.margin: float = margin
+        self.default_ttl: float = default_ttl
+        self.prefetch: int = prefetch
+        self.max_entries: int = max_entries
+        self.entries: OrderedDict[int, Tuple[str, float]] = OrderedDict()
+
+    def expiry_of(self, url: str) -> float:
+        expire = parse_expiry(url)
+        return expire if expire is not None else time.time() + self.default_ttl
+
+    def put(self, song_id: int, url: str, expires_at: Optional[float] = None):
+        self.entries[song_id] = (url, expires_at if expires_at is not None else self.expiry_of(url))
+        self.entries.move_to_end(song_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, song_id: int) -> Optional[str]:
+        entry = self.entries.get(song_id)
+        if entry is None:
+            return None
+        url, expires_at = entry
+        if expires_at - self.margin <= time.time():
+            del self.entries[song_id]
+            return None
+        return url
+
+    def expires_in(self, song_id: int) -> Optional[float]:
+        entry = self.entries.get(song_id)
+        return entry[1] - time.time() if entry else None
+
+    def needs_refresh(self, song_id: int, horizon: float = 0) -> bool:
+        remaining = self.expires_in(song_id)
+        return remaining is None or remaining - self.margin <= horizon
+
+    def is_fresh(self, url: Optional[str]) -> bool:
+        # Only trust urls whose lifetime is known, an unparseable db value might be long dead
+        expire = parse_expiry(url)
+        return expire is not None and expire - self.margin > time.time()
+
+    def prune(self) -> int:
+        # Urls past their margin are never handed out again, get() only drops the ones it happens to hit
+        cutoff = time.time() + self.margin
+        expired = [song_id for song_id, (_, expires_at) in self.entries.items() if expires_at <= cutoff]
+        for song_id in expired:
+            del self.entries[song_id]
+        return len(expired)
+
+    def invalidate(self, song_id: int):
+        self.entries.pop(song_id, None)
+
+    def clear(self):
+        self.entries.clear()
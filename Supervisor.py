@@ -0,0 +1,178 @@
+import asyncio
+import os
+import signal
+import subprocess
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import discord
+
+import Metrics
+from Sources import ffmpeg_process
+
+
+supervisor_options = {
+    # FFmpeg processes over all guilds, prefetching stops well before playback is refused
+    'max_processes': 24,
+    'prefetch_headroom': 4,
+    # Seconds without a frame from a playing source before FFmpeg is restarted at the same position
+    'stall_timeout': 10.0,
+    'max_restarts': 3,
+    # Unreferenced processes are left alone for this long, a source can be between two owners for a moment
+    'orphan_grace': 10.0,
+    # Playback waits this long for a free slot before giving up
+    'acquire_timeout': 15.0,
+}
+
+clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+class FFmpegLimitException(Exception):
+    def __init__(self, msg: str = "Gerade laufen zu viele Streams, versuch es gleich nochmal"):
+        super().__init__(msg)
+
+
+def process_usage(pid: int) -> Optional[Tuple[float, int]]:
+    # CPU seconds and resident bytes from /proc, None where that does not exist
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/statm") as f:
+            resident = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    # utime and stime are fields 14 and 15, counted after the ") " that ends the command name
+    return (int(fields[11]) + int(fields[12])) / clock_ticks, resident * page_size
+
+
+def child_transcoders() -> Dict[int, str]:
+    # FFmpeg children of this process writing audio to a pipe, which is how discord.py starts them.
+    # yt-dlp's own FFmpeg calls write to files and are never touched.
+    found = {}
+    own = str(os.getpid())
+    try:
+        pids = [p for p in os.listdir("/proc") if p.isdigit()]
+    except OSError:
+        return found
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                stat = f.read()
+            if stat.rsplit(")", 1)[1].split()[1] != own or "(ffmpeg)" not in stat:
+                continue
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                cmdline = f.read().split(b"\0")
+        except (OSError, IndexError):
+            continue
+        if b"pipe:1" in cmdline:
+            found[int(pid)] = b" ".join(cmdline).decode(errors="replace")
+    return found
+
+
+class FFmpegSupervisor:
+    def __init__(self, max_processes: int = 24, prefetch_headroom: int = 4, stall_timeout: float = 10.0,
+                 max_restarts: int = 3, orphan_grace: float = 10.0, acquire_timeout: float = 15.0):
+        self.max_processes: int = max_processes
+        self.prefetch_headroom: int = prefetch_headroom
+        self.stall_timeout: float = stall_timeout
+        self.max_restarts: int = max_restarts
+        self.orphan_grace: float = orphan_grace
+        self.acquire_timeout: float = acquire_timeout
+        # guild id -> processes started for it
+        self.processes: Dict[int, Set[subprocess.Popen]] = {}
+        # pid -> first time no player referenced it
+        self.unreferenced: Dict[int, float] = {}
+        # Untracked pids that were killed but not reaped yet
+        self.reaping: Set[int] = set()
+
+    def live(self) -> int:
+        return sum(1 for group in self.processes.values() for p in group if p.poll() is None)
+
+    def can_prefetch(self) -> bool:
+        return self.live() < self.max_processes - self.prefetch_headroom
+
+    async def acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        while self.live() >= self.max_processes:
+            if time.monotonic() > deadline:
+                raise FFmpegLimitException()
+            await asyncio.sleep(0.25)
+
+    def track(self, guild_id: int, source: discord.AudioSource):
+        process = ffmpeg_process(source)
+        if process is not None:
+            self.processes.setdefault(guild_id, set()).add(process)
+
+    def kill(self, process: subprocess.Popen, reason: str):
+        # Never waits, this runs on the event loop. The process stays tracked until a later poll() reaps it.
+        Metrics.ffmpeg_kills.inc(reason=reason)
+        try:
+            process.kill()
+        except Exception as e:
+            print(f"Could not kill FFmpeg {process.pid}: {e}")
+
+    def reap(self):
+        for pid in list(self.reaping):
+            try:
+                if os.waitpid(pid, os.WNOHANG)[0] == 0:
+                    continue
+            except ChildProcessError:
+                # Reaped by the Popen that started it
+                pass
+            self.reaping.discard(pid)
+
+    async def sweep(self, referenced: Dict[int, List[subprocess.Popen]]):
+        # referenced: guild id -> processes its player still plays or holds prefetched
+        self.reap()
+        # Reads /proc/<pid>/stat of every process on the host, too slow for the event loop on a busy one
+        found = await asyncio.get_running_loop().run_in_executor(None, child_transcoders)
+        now = time.monotonic()
+        in_use = {p.pid for group in referenced.values() for p in group}
+        tracked = set()
+        for guild_id in list(self.processes):
+            group = self.processes[guild_id]
+            for process in list(group):
+                tracked.add(process.pid)
+                if process.poll() is not None:
+                    group.discard(process)
+                    self.unreferenced.pop(process.pid, None)
+                    continue
+                if process.pid in in_use:
+                    self.unreferenced.pop(process.pid, None)
+                elif now - self.unreferenced.setdefault(process.pid, now) > self.orphan_grace:
+                    print(f"Killing orphaned FFmpeg {process.pid} of guild {guild_id}")
+                    self.kill(process, "orphan")
+                    self.unreferenced.pop(process.pid, None)
+            if not group:
+                del self.processes[guild_id]
+        # Left behind by an earlier Manager, e.g. after a cog reload
+        for pid in found.keys() - tracked - in_use - self.reaping:
+            if now - self.unreferenced.setdefault(pid, now) > self.orphan_grace:
+                print(f"Killing untracked FFmpeg {pid}")
+                Metrics.ffmpeg_kills.inc(reason="untracked")
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                    self.reaping.add(pid)
+                except OSError:
+                    pass
+                self.unreferenced.pop(pid, None)
+
+    def usage(self) -> Dict[Tuple[int, int], Tuple[float, int]]:
+        # (guild id, pid) -> (cpu seconds, rss bytes)
+        found = {}
+        for guild_id, group in list(self.processes.items()):
+            for process in list(group):
+                usage = process_usage(process.pid) if process.poll() is None else None
+                if usage is not None:
+                    found[(guild_id, process.pid)] = usage
+        return found
+
+    def close(self):
+        # On unload nothing may outlive the Manager, sources still being stopped included
+        for group in self.processes.values():
+            for process in group:
+                if process.poll() is None:
+                    self.kill(process, "unload")
+        self.processes.clear()
+        self.unreferenced.clear()
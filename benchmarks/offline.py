@@ -0,0 +1,422 @@
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import shutil
+import statistics
+import struct
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.request
+import wave
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord
+from aiohttp import web
+
+import Helpers
+import Metrics
+from Database import Base
+
+# Runs without network, Discord or YouTube: yt-dlp is replaced by recorded payloads, the voice client by a thread
+# that reads frames at real time pace, and stream urls point at a local HTTP server serving generated audio.
+
+payloads_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "payloads.json")
+
+sample_rate = 48000
+frame_bytes = 3840  # 20ms of 16 bit stereo at 48kHz, what discord.py reads per frame
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(q * len(values)) - 1))]
+
+
+def make_wav(seconds: float, pitch: float) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        samples = (int(8000 * math.sin(2 * math.pi * pitch * i / sample_rate)) for i in range(int(seconds * sample_rate)))
+        f.writeframes(b"".join(struct.pack("<hh", s, s) for s in samples))
+    return buffer.getvalue()
+
+
+class AudioServer:
+    def __init__(self, seconds: float):
+        self.seconds: float = seconds
+        self.files: Dict[str, bytes] = {}
+        self.requests: int = 0
+        self.runner: Optional[web.AppRunner] = None
+        self.base: str = ""
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        video_id = request.match_info["video_id"]
+        if video_id not in self.files:
+            self.files[video_id] = make_wav(self.seconds, 220 + zlib.crc32(video_id.encode()) % 440)
+        return web.Response(body=self.files[video_id], content_type="audio/wav")
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/audio/{video_id}.wav", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+class FakeExtractor:
+    # Same interface as Extractor.Extractor, answers from payloads.json after the recorded latency
+    def __init__(self, payloads: dict, server: AudioServer, latency_scale: float):
+        self.videos: Dict[str, dict] = {v["id"]: v for v in payloads["videos"]}
+        self.searches: Dict[str, str] = payloads["searches"]
+        self.playlists: Dict[str, dict] = payloads["playlists"]
+        self.server: AudioServer = server
+        self.latency_scale: float = latency_scale
+        self.calls: Dict[str, int] = {"search": 0, "video": 0, "playlist": 0}
+
+    def flat(self, video: dict) -> dict:
+        return {"id": video["id"], "title": video["title"], "channel": video["channel"], "duration": video["duration"],
+                "url": "https://www.youtube.com/watch?v=" + video["id"]}
+
+    def full(self, video: dict) -> dict:
+        return {**self.flat(video), "webpage_url": "https://www.youtube.com/watch?v=" + video["id"],
+                "url": f"{self.server.base}/audio/{video['id']}.wav"}
+
+    async def extract(self, query: str, opts: dict, download: bool = False, timeout: Optional[float] = None) -> Optional[dict]:
+        if download:
+            raise RuntimeError("Downloads are not part of the offline benchmark")
+        if query.startswith("ytsearch:"):
+            self.calls["search"] += 1
+            text = query[len("ytsearch:"):].lower()
+            video_id = self.searches.get(text) or sorted(self.videos)[zlib.crc32(text.encode()) % len(self.videos)]
+            video = self.videos[video_id]
+            await asyncio.sleep(video["latency"] * self.latency_scale / 2)
+            return {"entries": [self.flat(video)]}
+        if query in self.playlists:
+            self.calls["playlist"] += 1
+            playlist = self.playlists[query]
+            await asyncio.sleep(playlist["latency"] * self.latency_scale)
+            return {"title": playlist["title"], "entries": [self.flat(self.videos[i]) for i in playlist["entries"]]}
+        self.calls["video"] += 1
+        video = self.videos.get(query.split("v=")[-1])
+        if video is None:
+            return None
+        await asyncio.sleep(video["latency"] * self.latency_scale)
+        return self.full(video)
+
+    def shutdown(self):
+        pass
+
+
+class WavSource(discord.AudioSource):
+    # Stand-in for FFmpegPCMAudio when no FFmpeg is installed, honours the -ss of seeks and resumes
+    def __init__(self, url: str, options: dict):
+        self.url: str = url
+        before = options.get("before_options", "").split()
+        self.offset: float = float(before[before.index("-ss") + 1]) if "-ss" in before else 0.0
+        self.data: Optional[memoryview] = None
+        self.position: int = 0
+
+    def read(self) -> bytes:
+        if self.data is None:
+            # First read happens on the player thread, like FFmpeg connecting after the process started
+            with urllib.request.urlopen(self.url) as response:
+                self.data = memoryview(response.read())
+            self.position = 44 + int(self.offset * sample_rate) * 4
+        chunk = bytes(self.data[self.position:self.position + frame_bytes])
+        self.position += frame_bytes
+        return chunk if len(chunk) == frame_bytes else b""
+
+    def is_opus(self) -> bool:
+        return False
+
+
+class FakeVoiceClient:
+    def __init__(self, channel: "FakeVoiceChannel"):
+        self.channel: FakeVoiceChannel = channel
+        self.source: Optional[discord.AudioSource] = None
+        self.connected: bool = True
+        self.thread: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+        self.frames: int = 0
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def wait_until_connected(self):
+        pass
+
+    def is_playing(self) -> bool:
+        return self.thread is not None and self.thread.is_alive() and not self.stopped.is_set()
+
+    def play(self, source: discord.AudioSource, *, after=None, **_kwargs):
+        if self.is_playing():
+            raise discord.ClientException("Already playing audio.")
+        stopped = self.stopped = threading.Event()
+        self.source = source
+
+        def run():
+            error = None
+            try:
+                next_frame = time.perf_counter()
+                while not stopped.is_set():
+                    if not source.read():
+                        break
+                    self.frames += 1
+                    next_frame += 0.02
+                    stopped.wait(max(0.0, next_frame - time.perf_counter()))
+            except Exception as e:
+                error = e
+            finally:
+                source.cleanup()
+                if after:
+                    after(error)
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    async def disconnect(self, force: bool = False):
+        self.stop()
+        self.connected = False
+        self.channel.guild.voice_client = None
+
+    async def move_to(self, channel: "FakeVoiceChannel"):
+        self.channel = channel
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild: "FakeGuild", members: list):
+        self.id: int = guild.id * 10
+        self.guild: FakeGuild = guild
+        self.members: list = members
+
+    async def connect(self) -> FakeVoiceClient:
+        self.guild.voice_client = FakeVoiceClient(self)
+        return self.guild.voice_client
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id: int = guild_id
+        self.voice_client: Optional[FakeVoiceClient] = None
+
+
+class FakeResponse:
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction: FakeInteraction = interaction
+
+    async def defer(self, **_kwargs):
+        # Only shows "thinking", the first real message counts as the answer
+        pass
+
+    async def send_message(self, content: str = None, **_kwargs):
+        self.interaction.respond()
+
+
+class FakeFollowup:
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction: FakeInteraction = interaction
+
+    async def send(self, content: str = None, **_kwargs):
+        self.interaction.respond()
+
+
+class FakeInteraction:
+    def __init__(self, guild: FakeGuild, user, channel: FakeVoiceChannel):
+        self.guild_id: int = guild.id
+        self.guild: FakeGuild = guild
+        self.user = user
+        user.voice = types.SimpleNamespace(channel=channel)
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.created: float = time.perf_counter()
+        self.answered: Optional[float] = None
+
+    def respond(self):
+        if self.answered is None:
+            self.answered = time.perf_counter()
+
+    async def original_response(self):
+        return None
+
+
+def make_bot(loop: asyncio.AbstractEventLoop):
+    user = types.SimpleNamespace(id=1, bot=True, name="musi")
+
+    async def change_presence(**_kwargs):
+        pass
+
+    async def is_owner(_user) -> bool:
+        return True
+
+    return types.SimpleNamespace(loop=loop, tree=None, user=user, voice_clients=[], change_presence=change_presence,
+                                 is_owner=is_owner, get_channel=lambda _id: None,
+                                 get_guild=lambda _id: None)
+
+
+def workload(payloads: dict, songs: int) -> List[Tuple[str, dict]]:
+    searches = list(payloads["searches"])
+    videos = [v["id"] for v in payloads["videos"]]
+    playlist = next(iter(payloads["playlists"]))
+    steps: List[Tuple[str, dict]] = []
+    for i in range(songs):
+        if i % 3 == 2:
+            steps.append(("play", {"song": "https://youtu.be/" + videos[i % len(videos)]}))
+        else:
+            steps.append(("play", {"song": searches[i % len(searches)]}))
+    steps += [("queue", {"page": 1}), ("wait", {"seconds": 1.0}), ("skip", {}), ("wait", {"seconds": 0.5}), ("skip", {}),
+              ("playlist", {"playlist": playlist}), ("queue", {"page": 2}), ("play", {"song": searches[0]}),
+              ("wait", {"seconds": 6.0}), ("skip", {}), ("queue", {"page": 1}), ("stop", {})]
+    return steps
+
+
+async def run_guild(manager: "Helpers.Manager", guild_id: int, steps: List[Tuple[str, dict]],
+                    results: Dict[str, List[Tuple[float, float, int]]]):
+    guild = FakeGuild(guild_id)
+    user = types.SimpleNamespace(id=guild_id * 100, bot=False, name=f"user{guild_id}")
+    channel = FakeVoiceChannel(guild, [user, manager.bot.user])
+    for command, kwargs in steps:
+        if command == "wait":
+            await asyncio.sleep(kwargs["seconds"])
+            continue
+        interaction = FakeInteraction(guild, user, channel)
+        queries = Metrics.db_query_seconds.count()
+        await getattr(manager, command).callback(manager, interaction, **kwargs)
+        done = time.perf_counter()
+        # Queries of other guilds running at the same time end up in here as well, use --guilds 1 for exact counts
+        results.setdefault(command, []).append(((interaction.answered or done) - interaction.created,
+                                                done - interaction.created, Metrics.db_query_seconds.count() - queries))
+
+
+def report(results: Dict[str, List[Tuple[float, float, int]]], extractor: FakeExtractor, server: AudioServer, elapsed: float):
+    print(f"{'command':<10} {'n':>4} {'answer p50':>11} {'answer p99':>11} {'done p50':>10} {'done p99':>10} {'queries':>8}")
+    for command, rows in sorted(results.items()):
+        replies, dones, queries = zip(*rows)
+        print(f"{command:<10} {len(rows):>4} {percentile(replies, 0.5) * 1000:>9.1f}ms {percentile(replies, 0.99) * 1000:>9.1f}ms "
+              f"{percentile(dones, 0.5) * 1000:>8.1f}ms {percentile(dones, 0.99) * 1000:>8.1f}ms {statistics.mean(queries):>8.1f}")
+    for name, histogram in (("first audio", Metrics.first_audio_seconds), ("transition gap", Metrics.transition_gap_seconds)):
+        if histogram.count():
+            print(f"{name}: n={histogram.count()} p50={histogram.quantile(0.5) * 1000:.1f}ms "
+                  f"p99={histogram.quantile(0.99) * 1000:.1f}ms (bucket interpolated)")
+    print(f"db queries: {Metrics.db_query_seconds.count()} total, p50={Metrics.db_query_seconds.quantile(0.5) * 1000:.2f}ms")
+    print(f"extractions: {extractor.calls}, audio requests: {server.requests}, wall time: {elapsed:.1f}s")
+
+
+async def run(args, payloads: dict):
+    server = AudioServer(args.song_seconds)
+    await server.start()
+
+    # Everything the cog would persist goes to a scratch directory, Getter reads these options when it is built
+    workdir = tempfile.mkdtemp(prefix="musi-bench-")
+    db_path = os.path.join(workdir, "bench.sb")
+    if args.db:
+        shutil.copy(args.db, db_path)
+    Helpers.database_options["url"] = f"sqlite+aiosqlite:///{db_path}"
+    Helpers.audio_cache_options["directory"] = os.path.join(workdir, "audio_cache")
+    Helpers.audio_cache_options["play_threshold"] = 10 ** 9
+    Helpers.metrics_options["enabled"] = False
+    if not shutil.which("ffmpeg") or args.no_ffmpeg:
+        print("FFmpeg not used, audio is read straight from the local server")
+        Helpers.audio_mode = "pcm"
+
+        async def create_source(stream: str, options: dict, mode: str = "pcm", bitrate: int = 128) -> discord.AudioSource:
+            return WavSource(stream, options)
+        Helpers.create_source = create_source
+
+    manager = Helpers.Manager(make_bot(asyncio.get_running_loop()))
+    extractor = FakeExtractor(payloads, server, args.latency_scale)
+    manager.getter.extractor = extractor
+    if not args.db:
+        async with manager.getter.db.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+    await manager.cog_load()
+
+    results: Dict[str, List[Tuple[float, float, int]]] = {}
+    steps = workload(payloads, args.songs)
+    started = time.perf_counter()
+    await asyncio.gather(*(run_guild(manager, 1000 + g, steps, results) for g in range(args.guilds)))
+    elapsed = time.perf_counter() - started
+
+    await manager.cog_unload()
+    await server.stop()
+    shutil.rmtree(workdir, ignore_errors=True)
+    report(results, extractor, server, elapsed)
+
+
+def record(path: str, queries: List[str], playlists: List[str]):
+    # Needs network, stores trimmed yt-dlp results in the format FakeExtractor replays
+    from yt_dlp import YoutubeDL
+    opts = {**Helpers.ydl_opts, "quiet": True, "no_warnings": True}
+    videos: Dict[str, dict] = {}
+    searches: Dict[str, str] = {}
+    recorded_playlists: Dict[str, dict] = {}
+
+    def add_video(url: str) -> Optional[str]:
+        started = time.perf_counter()
+        with YoutubeDL(opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+        videos[info["id"]] = {"id": info["id"], "title": info["title"], "channel": info.get("channel") or info.get("uploader"),
+                              "duration": info.get("duration") or 0, "latency": round(time.perf_counter() - started, 2)}
+        return info["id"]
+
+    for query in queries:
+        with YoutubeDL({**opts, "extract_flat": True}) as ydl:
+            entries = (ydl.extract_info("ytsearch:" + query, download=False) or {}).get("entries") or []
+        if entries:
+            searches[query.lower()] = add_video("https://www.youtube.com/watch?v=" + entries[0]["id"])
+    for url in playlists:
+        started = time.perf_counter()
+        with YoutubeDL({**opts, "extract_flat": "in_playlist", "noplaylist": False}) as ydl:
+            info = ydl.extract_info(url, download=False)
+        latency = round(time.perf_counter() - started, 2)
+        ids = [add_video("https://www.youtube.com/watch?v=" + e["id"]) for e in (info.get("entries") or [])[:20] if e]
+        recorded_playlists[url] = {"title": info.get("title") or url, "latency": latency, "entries": ids}
+
+    with open(path, "w") as f:
+        json.dump({"videos": list(videos.values()), "searches": searches, "playlists": recorded_playlists}, f, indent=1)
+    print(f"Recorded {len(videos)} videos into {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of Manager with fake yt-dlp and voice clients")
+    parser.add_argument("--guilds", type=int, default=3, help="guilds running the workload at the same time")
+    parser.add_argument("--songs", type=int, default=12, help="/play commands per guild")
+    parser.add_argument("--song-seconds", type=float, default=3.0, help="length of the served audio")
+    parser.add_argument("--latency-scale", type=float, default=0.25, help="factor on the recorded extraction latency")
+    parser.add_argument("--payloads", default=payloads_path)
+    parser.add_argument("--db", help="start from a copy of this database instead of an empty one")
+    parser.add_argument("--no-ffmpeg", action="store_true", help="read audio without FFmpeg even if it is installed")
+    parser.add_argument("--record", metavar="PATH", help="record payloads with yt-dlp instead of benchmarking")
+    parser.add_argument("--playlist", action="append", default=[], help="playlist url to record, repeatable")
+    parser.add_argument("queries", nargs="*", help="search queries to record")
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.record, args.queries, args.playlist)
+        return
+    with open(args.payloads) as f:
+        payloads = json.load(f)
+    asyncio.run(run(args, payloads))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from yt_dlp import YoutubeDL
+
+import Extractor
+from Helpers import ydl_opts
+
+# Needs network access, compares a fresh YoutubeDL per lookup with the pooled instances of Extractor
+
+default_queries = [
+    "ytsearch:never gonna give you up",
+    "ytsearch:bohemian rhapsody",
+    "ytsearch:daft punk around the world",
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://www.youtube.com/watch?v=fJ9rUzIMcZQ",
+]
+
+
+def cold(query: str, opts: dict):
+    with YoutubeDL(opts) as ydl:
+        ydl.extract_info(query, download=False)
+
+
+def warm(query: str, opts: dict):
+    Extractor._extract_info(query, opts, recycle_after=10 ** 6)
+
+
+def run(name: str, fn, queries, opts: dict, rounds: int):
+    timings = []
+    for _ in range(rounds):
+        for query in queries:
+            start = time.perf_counter()
+            fn(query, opts)
+            timings.append(time.perf_counter() - start)
+    timings.sort()
+    p90 = timings[int(len(timings) * 0.9) - 1] if len(timings) >= 10 else timings[-1]
+    print(f"{name:>5}: n={len(timings)} mean={statistics.mean(timings) * 1000:.0f}ms "
+          f"p50={statistics.median(timings) * 1000:.0f}ms p90={p90 * 1000:.0f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold vs warm yt-dlp extraction latency")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("queries", nargs="*", default=default_queries)
+    args = parser.parse_args()
+
+    opts = {**ydl_opts, 'quiet': True, 'no_warnings': True}
+    # Prime the on-disk cache so both runs start from the same state
+    cold(args.queries[0], opts)
+    run("cold", cold, args.queries, opts, args.rounds)
+    run("warm", warm, args.queries, opts, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
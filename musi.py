@@ -1,13 +1,30 @@
+import argparse
+
 import discord
 import validators
 from discord.ext import commands
 from discord import app_commands
-from discord.ext.commands import Bot, Cog, check, is_owner, guild_only, Context
+from discord.ext.commands import AutoShardedBot, Bot, Cog, check, is_owner, guild_only, Context
 
 from Helpers import Manager
 
-bot = Bot(command_prefix="-", intents=discord.Intents.all(), help_command=None,
-          activity=discord.Game(name="Loading..."), status=discord.Status.dnd)
+# Several processes can split the shards between them, e.g. --shard-count 4 --shard-ids 0 1 and --shard-count 4 --shard-ids 2 3.
+# They share musiDB.sb, so songs and stream urls resolved by one process are reused by the others.
+parser = argparse.ArgumentParser(description="Musi")
+parser.add_argument("--shard-count", type=int, help="total number of shards over all processes")
+parser.add_argument("--shard-ids", type=int, nargs="*", help="shards run by this process, all of them if omitted")
+args = parser.parse_args()
+if args.shard_ids and not args.shard_count:
+    parser.error("--shard-ids needs --shard-count, every process has to agree on the total")
+if args.shard_ids and not all(0 <= i < args.shard_count for i in args.shard_ids):
+    parser.error(f"--shard-ids must be between 0 and {args.shard_count - 1}")
+
+bot_options = dict(command_prefix="-", intents=discord.Intents.all(), help_command=None,
+                   activity=discord.Game(name="Loading..."), status=discord.Status.dnd)
+if args.shard_count or args.shard_ids:
+    bot = AutoShardedBot(shard_count=args.shard_count, shard_ids=args.shard_ids or None, **bot_options)
+else:
+    bot = Bot(**bot_options)
 
 
 @bot.event